@@ -0,0 +1,754 @@
+"""
+The benchmark module.
+
+Times the redactor against generated data in a scratch
+database, so changes can be measured.
+
+Each scenario seeds its scratch database in one process
+and runs in another, and reports the throughput, the p50
+and p99 time between processed messages, and the peak
+memory of the process, so seeding isn't measured.
+
+Usage:
+    python benchmark.py redact --sizes 1000 100000 1000000
+    python benchmark.py extract --sizes 1000 --latency 20 \
+        --fetch-mode threads --message-format raw
+    python benchmark.py pending --sizes 10000 100000 1000000
+"""
+
+import argparse
+import base64
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import config
+import extract
+import models
+import redact
+import transform
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from itertools import islice
+from sqlalchemy.orm import sessionmaker
+
+# the index columns of the transform benchmark
+TRANSFORM_COLUMNS = [
+    ('subject', 'Subject'),
+    ('email_from', 'From'),
+    ('email_to', 'To'),
+    ('time', 'Date'),
+]
+
+# the number of messages per synthetic gmail thread
+THREAD_LENGTH = 4
+
+NAMES = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi']
+DOMAINS = ['example.com', 'mail.example.org', 'shop.example.net', 'isp.net']
+WORDS = ('the order has been shipped and will arrive soon please let us '
+         'know if there is anything else we can help with regarding your '
+         'account invoice delivery refund request').split()
+
+def percentile(values, percent):
+    """
+    Get a percentile of some values.
+
+    Args:
+        values: list - the values
+        percent: the percentile to get, from 0 to 100
+
+    Returns:
+        the value at the percentile
+    """
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def address(generator):
+    """
+    Generate an email address.
+    """
+    return '{}.{}@{}'.format(
+                generator.choice(NAMES),
+                generator.randint(1, 999),
+                generator.choice(DOMAINS))
+
+def phone_number(generator):
+    """
+    Generate a phone number in one of the shapes the
+    phone number detector targets.
+    """
+    shapes = [
+        '({:03d}) {:03d}-{:04d}',
+        '{:03d}-{:03d}-{:04d}',
+        '{:03d}.{:03d}.{:04d}',
+        '({:02d}) {:03d}{:04d}',
+    ]
+
+    return generator.choice(shapes).format(
+                generator.randint(10, 999),
+                generator.randint(100, 999),
+                generator.randint(0, 9999))
+
+def ip_address(generator):
+    """
+    Generate an ip address.
+    """
+    return '.'.join(str(generator.randint(0, 255)) for _ in range(4))
+
+def sentence(generator):
+    """
+    Generate a sentence, sometimes containing redactable
+    contents.
+    """
+    words = [generator.choice(WORDS) for _ in range(generator.randint(8, 20))]
+    roll = generator.random()
+
+    if roll < 0.1:
+        words.append(phone_number(generator))
+    elif roll < 0.15:
+        words.append(ip_address(generator))
+    elif roll < 0.3:
+        words.append(address(generator))
+
+    return ' '.join(words).capitalize() + '.'
+
+def html_body(generator, paragraphs):
+    """
+    Generate an html order email body, with member links and
+    delivery address rows for the html parser.
+    """
+    member = generator.randint(1, 100000)
+    rows = [
+        '<tr><td>Item</td><td>{}</td></tr>'.format(generator.choice(WORDS)),
+        '<tr><td>Delivery address</td><td>{} {} St</td></tr>'.format(
+            generator.randint(1, 200), generator.choice(NAMES).title()),
+        '<tr><td>Total</td><td>${}.00</td></tr>'.format(
+            generator.randint(5, 500)),
+    ]
+
+    return ''.join([
+        '<html><body>',
+        ''.join('<p>{}</p>'.format(paragraph) for paragraph in paragraphs),
+        '<table>{}</table>'.format(''.join(rows)),
+        '<a href="https://shop.example.net/account?member={}">'
+            'Member {}</a>'.format(member, member),
+        '</body></html>',
+    ])
+
+def synthetic_email(number):
+    """
+    Generate a realistic email.
+
+    Emails are generated from their number alone, so any email
+    can be regenerated without keeping the mailbox in memory.
+
+    Args:
+        number: the number of the email, from 0
+
+    Returns:
+        dict - the Email column values
+    """
+    generator = random.Random(number)
+    paragraphs = [' '.join(sentence(generator)
+                            for _ in range(generator.randint(1, 5)))
+                    for _ in range(generator.randint(1, 8))]
+
+    if generator.random() < 0.5:
+        body = html_body(generator, paragraphs)
+    else:
+        body = '\n\n'.join(paragraphs)
+
+    return {
+        'subject': u'Re: {}'.format(sentence(generator)[:60]),
+        'email_from': u'{} <{}>'.format(
+                        generator.choice(NAMES).title(), address(generator)),
+        'email_to': address(generator).decode('ascii'),
+        'time': datetime(2018, 1, 1) + timedelta(minutes=number),
+        'body': body.decode('ascii'),
+        'external_id': u'message{}'.format(number),
+        'thread_id': u'thread{}'.format(number // THREAD_LENGTH),
+    }
+
+def synthetic_emails(count):
+    """
+    Generate a mailbox of realistic emails.
+
+    Yields:
+        dict - the Email column values of each email
+    """
+    for number in range(count):
+        yield synthetic_email(number)
+
+class FakeRequest(object):
+    """
+    A fake api request that runs a function when executed.
+    """
+
+    def __init__(self, response, latency):
+        """
+        FakeRequest constructor.
+
+        Args:
+            response: callable returning the response
+            latency: seconds to wait before responding
+        """
+        self._response = response
+        self._latency = latency
+
+    def execute(self, http=None, num_retries=0):
+        """
+        Execute the request.
+        """
+        if self._latency:
+            time.sleep(self._latency)
+
+        return self._response()
+
+class FakeBatch(object):
+    """
+    A fake gmail batch request.
+    """
+
+    def __init__(self, callback, latency):
+        """
+        FakeBatch constructor.
+        """
+        self._callback = callback
+        self._latency = latency
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        """
+        Add a request to the batch.
+        """
+        self._requests.append((request_id, request))
+
+    def execute(self, http=None):
+        """
+        Execute every request in the batch in one round trip.
+        """
+        if self._latency:
+            time.sleep(self._latency)
+
+        for request_id, request in self._requests:
+            self._callback(request_id, request._response(), None)
+
+class FakeGmailService(object):
+    """
+    A fake of the gmail api service, serving a mailbox of
+    synthetic emails.
+
+    Each request waits for the given latency, to stand in
+    for the network round trip.
+    """
+
+    def __init__(self, count, latency=0, page_size=100):
+        """
+        FakeGmailService constructor.
+
+        Args:
+            count: the number of emails in the mailbox
+            latency: seconds each round trip takes
+            page_size: the number of messages per list page
+        """
+        self._count = count
+        self._latency = latency
+        self._page_size = page_size
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest(
+                    lambda: {'historyId': str(self._count)}, self._latency)
+
+    def list(self, userId, q=None, pageToken=None, startHistoryId=None,
+                historyTypes=None):
+        if startHistoryId is not None:
+            return FakeRequest(lambda: {'history': []}, self._latency)
+
+        start = int(pageToken or 0)
+        end = min(start + self._page_size, self._count)
+
+        def response():
+            page = {
+                'messages': [
+                    {'id': 'message{}'.format(number),
+                        'threadId': 'thread{}'.format(
+                                        number // THREAD_LENGTH)}
+                    for number in range(start, end)
+                ]
+            }
+
+            if end < self._count:
+                page['nextPageToken'] = str(end)
+
+            return page
+
+        return FakeRequest(response, self._latency)
+
+    def get(self, userId, id, format='full', fields=None):
+        number = int(id[len('message'):])
+
+        if format == 'raw':
+            return FakeRequest(lambda: self.raw(number), self._latency)
+
+        if fields:
+            return FakeRequest(lambda: self.metadata(number), self._latency)
+
+        return FakeRequest(lambda: self.message(number), self._latency)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback, self._latency)
+
+    def parts(self, email):
+        """
+        Get the mime parts of a synthetic email, a plain text
+        alternative is added to html bodies.
+
+        Returns:
+            list - the (mime type, content) of each part
+        """
+        if email['body'].startswith('<'):
+            return [('text/plain', email['email_from']),
+                    ('text/html', email['body'])]
+
+        return [('text/plain', email['body'])]
+
+    def message(self, number):
+        """
+        Get a synthetic email in the gmail 'full' format.
+        """
+        email = synthetic_email(number)
+        epoch = time.mktime(email['time'].timetuple())
+        parts = [{
+            'mimeType': mime,
+            'filename': '',
+            'body': {
+                'size': len(content),
+                'data': base64.urlsafe_b64encode(content.encode('utf-8')),
+            },
+        } for mime, content in self.parts(email)]
+
+        if len(parts) == 1:
+            payload = parts[0]
+        else:
+            payload = {
+                'mimeType': 'multipart/alternative',
+                'filename': '',
+                'body': {'size': 0},
+                'parts': parts,
+            }
+
+        payload['headers'] = [
+            {'name': 'Subject', 'value': email['subject']},
+            {'name': 'From', 'value': email['email_from']},
+            {'name': 'To', 'value': email['email_to']},
+        ]
+
+        return {
+            'id': email['external_id'],
+            'threadId': email['thread_id'],
+            'internalDate': str(int(epoch * 1000)),
+            'payload': payload,
+        }
+
+    def metadata(self, number):
+        """
+        Get a synthetic email in the gmail 'full' format,
+        without any part data, like a partial response.
+        """
+        message = self.message(number)
+        payload = message['payload']
+
+        for part in [payload] + payload.get('parts', []):
+            part['body'].pop('data', None)
+
+        return message
+
+    def raw(self, number):
+        """
+        Get a synthetic email in the gmail 'raw' format.
+        """
+        email = synthetic_email(number)
+        parts = [MIMEText(content.encode('utf-8'), mime.split('/')[1],
+                            'utf-8')
+                    for mime, content in self.parts(email)]
+
+        if len(parts) == 1:
+            mime = parts[0]
+        else:
+            mime = MIMEMultipart('alternative')
+
+            for part in parts:
+                mime.attach(part)
+
+        mime['Subject'] = email['subject']
+        mime['From'] = email['email_from']
+        mime['To'] = email['email_to']
+
+        return {
+            'id': email['external_id'],
+            'raw': base64.urlsafe_b64encode(mime.as_string()),
+        }
+
+class Recorder(object):
+    """
+    Records the time between processed messages.
+    """
+
+    def __init__(self):
+        """
+        Recorder constructor.
+        """
+        self.latencies = []
+        self._last = time.time()
+
+    def mark(self, count=1):
+        """
+        Mark messages as processed, a batch of messages
+        shares the time taken evenly.
+        """
+        now = time.time()
+        self.latencies.extend([(now - self._last) / count] * count)
+        self._last = now
+
+@contextmanager
+def observe(owner, name, recorder, batched=False):
+    """
+    Mark the recorder each time a method or function
+    returns, while in the context.
+
+    Args:
+        owner: the class or module the callable belongs to
+        name: the name of the callable
+        recorder: Recorder - the recorder to mark
+        batched: whether the callable returns a list of
+            processed messages, rather than one
+    """
+    original = getattr(owner, name)
+
+    def observed(*args, **kwargs):
+        result = original(*args, **kwargs)
+
+        if not batched:
+            recorder.mark()
+        elif result:
+            recorder.mark(len(result))
+
+        return result
+
+    setattr(owner, name, observed)
+
+    try:
+        yield
+    finally:
+        setattr(owner, name, original)
+
+def scratch_engine(directory, name):
+    """
+    Create a scratch database with the redactor's tables.
+
+    Args:
+        directory: the directory to create the database in
+        name: the name of the database file
+
+    Returns:
+        engine: the db engine of the scratch database
+    """
+    engine = models.sqlite_engine(os.path.join(directory, name))
+    models.Base.metadata.create_all(engine)
+    return engine
+
+def seeded_engine(directory, name):
+    """
+    Open a scratch database seeded by a benchmark's setup.
+
+    Returns:
+        engine: the db engine of the scratch database
+    """
+    return models.sqlite_engine(os.path.join(directory, name))
+
+def seed(model, size):
+    """
+    Store a synthetic mailbox in the bound db.
+
+    Args:
+        model: the model to store the emails as
+        size: the number of emails to store
+    """
+    models.bulk_insert(model, synthetic_emails(size), chunk_size=10000)
+
+def setup_extract(directory, size, options):
+    """
+    Create the empty database extraction stores into.
+    """
+    scratch_engine(directory, 'extract.db')
+
+def bench_extract(directory, size, options):
+    """
+    Time extraction from a fake gmail service.
+    """
+    models.bind(seeded_engine(directory, 'extract.db'))
+    extractor = extract.GMailExtractor(
+                    FakeGmailService(size, options.latency / 1000.0),
+                    http_factory=lambda: None,
+                    fetch_mode=options.fetch_mode,
+                    message_format=options.message_format)
+    session = models.db_session()
+    recorder = Recorder()
+
+    parse = 'parse_raw' if options.message_format == 'raw' \
+                else 'parse_message'
+
+    with observe(extract.GMailExtractor, parse, recorder):
+        history_id, pages = extract.sync_pages(extractor, session, '')
+
+        for messages in pages:
+            extract.extract_messages(extractor, messages)
+
+    return recorder.latencies
+
+def setup_redact(directory, size, options):
+    """
+    Store the mailbox to redact.
+    """
+    models.bind(scratch_engine(directory, 'redact.db'))
+    seed(models.Email, size)
+
+def bench_redact(directory, size, options):
+    """
+    Time redaction of a stored mailbox.
+    """
+    models.bind(seeded_engine(directory, 'redact.db'))
+    recorder = Recorder()
+
+    with observe(redact, 'redact_many', recorder, batched=True):
+        redact.run()
+
+    return recorder.latencies
+
+def setup_transform(directory, size, options):
+    """
+    Store the redacted mailbox to transform.
+    """
+    models.bind(scratch_engine(directory, 'transform.db'))
+    seed(models.RedactedEmail, size)
+
+def bench_transform(directory, size, options):
+    """
+    Time transformation of a stored mailbox.
+    """
+    models.bind(seeded_engine(directory, 'transform.db'))
+    recorder = Recorder()
+
+    # generate the pages and files in the scratch directory,
+    # with columns every email has rather than the config's
+    config.generation_root = os.path.join(directory, 'generated')
+    config.email_type = 'RedactedEmail'
+    config.table_columns = TRANSFORM_COLUMNS
+
+    # mark each row of transform's loop, as it's written to its page
+    with observe(transform.PageManifest, 'write_row', recorder):
+        transform.run()
+
+    return recorder.latencies
+
+def seed_pending(engine, size, pending_every):
+    """
+    Store emails and redact all but every nth of them.
+
+    Args:
+        engine: the db engine to seed
+        size: the number of emails to store
+        pending_every: every nth email is left unredacted
+    """
+    session = sessionmaker(bind=engine)()
+    now = datetime.now()
+
+    def emails(table):
+        for email_id in range(1, size + 1):
+            if table is models.RedactedEmail \
+                    and not email_id % pending_every:
+                continue
+
+            yield {
+                'id': email_id,
+                'subject': u'subject {}'.format(email_id),
+                'email_from': u'',
+                'email_to': u'',
+                'time': now,
+                'body': u'',
+                'external_id': u'{}'.format(email_id),
+                'thread_id': u'',
+            }
+
+    for table in (models.Email, models.RedactedEmail):
+        models.bulk_insert(table, emails(table),
+                            chunk_size=10000, session=session)
+
+    session.close()
+
+def setup_pending(directory, size, options):
+    """
+    Store the emails, with every 10th email left unredacted.
+    """
+    seed_pending(scratch_engine(directory, 'pending.db'), size, 10)
+
+def bench_pending(directory, size, options):
+    """
+    Time the pages of pending emails that redaction streams.
+
+    Every 10th email is left unredacted, and pages of 100
+    pending emails are read.
+
+    Returns:
+        list - the time taken by each page, in seconds
+    """
+    models.bind(seeded_engine(directory, 'pending.db'))
+
+    # read each page when it's used, so it's timed on its own
+    rows = models.stream(
+                lambda session: redact.pending_query(
+                    session, redact.ROW_COLUMNS),
+                models.Email.id, 100, prefetch=False)
+    timings = []
+
+    for _ in range(options.batches):
+        start = time.time()
+        page = list(islice(rows, 100))
+        timings.append(time.time() - start)
+
+        if not page:
+            break
+
+    rows.close()
+    return timings
+
+# the (setup, benchmark) of each scenario
+BENCHMARKS = {
+    'extract': (setup_extract, bench_extract),
+    'redact': (setup_redact, bench_redact),
+    'transform': (setup_transform, bench_transform),
+    'pending': (setup_pending, bench_pending),
+}
+
+def prepare(name, size, options, directory, results):
+    """
+    Seed a benchmark's scratch directory and put whether
+    it succeeded on the results queue.
+    """
+    try:
+        BENCHMARKS[name][0](directory, size, options)
+        results.put(True)
+    except:
+        results.put(None)
+        raise
+
+def measure(name, size, options, directory, results):
+    """
+    Run a benchmark in its seeded scratch directory and put
+    its measurements on the results queue.
+    """
+    try:
+        start = time.time()
+        latencies = BENCHMARKS[name][1](directory, size, options)
+        elapsed = time.time() - start
+
+        # linux reports the peak resident set size in KB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        results.put((elapsed, latencies, peak))
+    except:
+        results.put(None)
+        raise
+
+def in_process(target, *args):
+    """
+    Run a function in a fresh process, so the peak memory
+    is its own.
+
+    Returns:
+        the value the function put on its results queue
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target,
+                                        args=args + (results,))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def report(name, size, elapsed, latencies, peak):
+    """
+    Print the measurements of a benchmark.
+    """
+    if not latencies:
+        print('{:<10} {:>9} nothing processed'.format(name, size))
+        return
+
+    print('{:<10} {:>9} {:9.1f}/s p50 {:8.3f}ms p99 {:8.3f}ms '
+          'rss {:7.1f}MB'.format(
+            name, size,
+            len(latencies) / elapsed,
+            1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 99),
+            peak / 1024.0))
+
+def run():
+    """
+    Run the benchmarks.
+    """
+    parser = argparse.ArgumentParser(description='Run benchmarks.')
+    parser.add_argument('benchmarks', nargs='+', choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+        help='the numbers of emails to benchmark with')
+    parser.add_argument(
+        '--batches', type=int, default=50,
+        help='the number of pages to time in the pending benchmark')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='the fake gmail round trip time in ms')
+    parser.add_argument(
+        '--fetch-mode', default='serial',
+        choices=['serial', 'batch', 'threads'],
+        help='the gmail fetch mode to extract with')
+    parser.add_argument(
+        '--message-format', default='full', choices=['full', 'raw'],
+        help='the gmail message format to extract with')
+    options = parser.parse_args()
+
+    for name in options.benchmarks:
+        for size in options.sizes:
+            directory = tempfile.mkdtemp()
+
+            try:
+                result = in_process(prepare, name, size, options, directory) \
+                            and in_process(measure, name, size, options,
+                                            directory)
+            finally:
+                shutil.rmtree(directory)
+
+            if result is None:
+                print('{:<10} {:>9} failed'.format(name, size))
+                continue
+
+            report(name, size, *result)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,232 @@
+"""
+The cache module.
+
+Caches redacted email fields by a hash of their content,
+so duplicate bodies and repeated quoted text are only
+redacted once.
+
+Entries are keyed with a fingerprint of the redaction
+config, so changing the config invalidates them.
+"""
+
+import hashlib
+import metrics
+import models
+import threading
+
+from cachetools import LRUCache
+from sqlalchemy import select
+from sqlalchemy import Column, MetaData, String, Table
+
+# bump to invalidate cached redactions when redaction changes
+VERSION = 2
+
+# the shortest content worth storing in the persistent tier
+PERSIST_MIN_LENGTH = 1024
+
+# the number of entries written to the persistent tier at once
+PERSIST_BATCH_SIZE = 100
+
+metadata = MetaData()
+
+redactions = Table(
+    'redactions', metadata,
+    Column('key', String, primary_key=True),
+    Column('fingerprint', String, index=True),
+    Column('value', String),
+)
+
+def fingerprint(redaction_string, excludes, detectors):
+    """
+    Fingerprint a redaction config.
+
+    Args:
+        redaction_string: the string matches are replaced with
+        excludes: list - the configured 'excludes'
+        detectors: list - the registered Detectors
+
+    Returns:
+        string - a hash of everything redaction depends on
+    """
+    digest = hashlib.sha1()
+    parts = [str(VERSION), redaction_string]
+    parts.extend(sorted(excludes))
+
+    for detector in detectors:
+        parts.append(detector.name)
+        parts.append(detector.pattern)
+        parts.extend(detector.fields)
+        parts.append(str(detector.excludable))
+
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf8')
+
+        digest.update(part)
+        digest.update('\0')
+
+    return digest.hexdigest()
+
+class RedactionCache(object):
+    """
+    The Redaction Cache.
+
+    Keeps redacted fields in an in-memory LRU and, optionally,
+    in a SQLite file that outlives the process.
+    """
+
+    def __init__(self, fingerprint, size, path=None):
+        """
+        RedactionCache constructor.
+
+        Args:
+            fingerprint: the fingerprint of the redaction config
+            size: the number of characters of redacted content
+                to keep in memory
+            path: the SQLite file of the persistent tier, or None
+                to only cache in memory
+        """
+        self._fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._memory = LRUCache(size, getsizeof=len) if size else None
+        self._engine = None
+        self._writes = []
+
+        if path:
+            self._engine = models.sqlite_engine(path)
+            metadata.create_all(self._engine)
+
+            # drop entries cached with a different config
+            self._engine.execute(redactions.delete().where(
+                redactions.c.fingerprint != fingerprint))
+
+    def key(self, field, content):
+        """
+        Get the cache key of a field's content.
+        """
+        digest = hashlib.sha1(self._fingerprint)
+        digest.update(field)
+        digest.update('\0')
+        digest.update(content.encode('utf8')
+                        if isinstance(content, unicode) else content)
+        return digest.hexdigest()
+
+    def _get(self, key, persist):
+        """
+        Look a key up in each tier.
+        """
+        with self._lock:
+            if self._memory is not None and key in self._memory:
+                metrics.incr('cache_hits_total', tier='memory')
+                return self._memory[key]
+
+        if persist:
+            row = self._engine.execute(
+                    select([redactions.c.value]) \
+                        .where(redactions.c.key == key)).first()
+
+            if row is not None:
+                metrics.incr('cache_hits_total', tier='sqlite')
+                self._remember(key, row[0])
+                return row[0]
+
+        metrics.incr('cache_misses_total')
+
+    def _remember(self, key, value):
+        """
+        Keep a value in memory.
+        """
+        if self._memory is None or len(value) > self._memory.maxsize:
+            return
+
+        with self._lock:
+            self._memory[key] = value
+
+    def _persists(self, content):
+        """
+        Check whether content is cached in the persistent tier.
+        """
+        return self._engine is not None \
+                and len(content) >= PERSIST_MIN_LENGTH
+
+    def _put(self, key, value, persist):
+        """
+        Keep a value in memory, and in the persistent tier.
+        """
+        self._remember(key, value)
+
+        if not persist:
+            return
+
+        with self._lock:
+            self._writes.append({
+                'key': key,
+                'fingerprint': self._fingerprint,
+                'value': value,
+            })
+
+            if len(self._writes) < PERSIST_BATCH_SIZE:
+                return
+
+        self.flush()
+
+    def get(self, field, content):
+        """
+        Get the cached redacted content of a field.
+
+        Args:
+            field: the name of the email field
+            content: the content of the field
+
+        Returns:
+            string - the redacted content, or None on a miss
+        """
+        return self._get(self.key(field, content), self._persists(content))
+
+    def put(self, field, content, value):
+        """
+        Cache the redacted content of a field.
+
+        Args:
+            field: the name of the email field
+            content: the content of the field
+            value: the redacted content
+        """
+        self._put(self.key(field, content), value, self._persists(content))
+
+    def redacted(self, field, content, redact):
+        """
+        Get the redacted content of a field, redacting it
+        on a cache miss.
+
+        Args:
+            field: the name of the email field
+            content: the content of the field
+            redact: callable redacting the content
+
+        Returns:
+            string - the redacted content
+        """
+        if not isinstance(content, basestring):
+            return redact(content)
+
+        persist = self._persists(content)
+        key = self.key(field, content)
+        value = self._get(key, persist)
+
+        if value is None:
+            value = redact(content)
+            self._put(key, value, persist)
+
+        return value
+
+    def flush(self):
+        """
+        Write pending entries to the persistent tier.
+        """
+        with self._lock:
+            writes, self._writes = self._writes, []
+
+        if writes:
+            self._engine.execute(
+                redactions.insert().prefix_with('OR IGNORE'), writes)
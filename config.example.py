@@ -4,7 +4,9 @@ An example config file.
 Populate the below config variables as necessary.
 """
 
-# strings to exclude during redaction
+# strings to exclude during redaction, an email address
+# containing one is left as is, apart from any phone number
+# or ip address in it
 excludes = [
     "example_string"
 ]
@@ -12,9 +14,43 @@ excludes = [
 # the string to replace redactable strings with
 redaction_string = "[REDACTED]"
 
+# modules of extra detectors to redact with, each defining
+# a DETECTORS list of detectors.Detector, a detector with
+# the same name as a built in detector replaces it
+detector_packs = []
+
+# the number of characters of redacted content to cache
+# in memory, so duplicate bodies are only redacted once,
+# 0 to not cache in memory
+redaction_cache_size = 32 * 1024 * 1024
+
+# a sqlite file to also cache redacted bodies in across
+# runs, None to only cache in memory
+redaction_cache_file = None
+
+# the number of characters of redacted html blocks to
+# remember, so text quoted from earlier emails in a thread
+# isn't redacted again, 0 to not remember any
+thread_delta_size = 0
+
 # sqlite file
 sqlite_file = "store.db"
 
+# compress stored email bodies with 'zlib' or 'zstd', zstd
+# needs the zstandard package, None stores plain text
+body_compression = None
+body_compression_level = 6
+
+# a trained zstd dictionary file shared by every body
+body_compression_dictionary = None
+
+# sqlite pragmas applied to each db connection, on top of
+# the defaults in models.SQLITE_PRAGMAS, None skips a pragma
+sqlite_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+}
+
 # google token file
 # this file will be generated when the extractor is run
 # i.e. when extract.py is run
@@ -46,6 +82,75 @@ table_columns = [
 # tranform.py will generate files in this folder
 generation_root = ''
 
+# FULL path to the folder the pipeline writes to when run
+# with --no-persist, defaults to an 'unpersisted' folder
+# in the generation root
+unpersisted_root = ''
+
 # email type to transform
 # email_type = 'Email'
 email_type = 'RedactedEmail'
+
+# how messages are fetched from gmail
+# 'serial' - one request per message
+# 'batch' - up to gmail_batch_size messages per batch request
+# 'threads' - gmail_fetch_workers requests in flight at once
+gmail_fetch_mode = 'serial'
+gmail_fetch_workers = 8
+gmail_batch_size = 100
+
+# the format messages are fetched in
+# 'full' - each message's part tree, with every part decoded
+# 'raw' - a partial response of each message's headers and part
+#   tree first, then the raw mime of only the messages with a body
+gmail_message_format = 'full'
+
+# fetch the next page of the message list in the background
+gmail_prefetch_pages = False
+
+# the number of emails redacted together, their subjects,
+# froms and tos are each scanned in one pass
+redact_batch_size = 100
+
+# keep a full text search index of the redacted emails,
+# searched with search.py, needs sqlite built with fts5
+search_index = False
+
+# record where each detector matched in the redacted emails,
+# so changed excludes and redaction_string can be applied
+# with 'python redact.py --reapply' instead of redacting again
+span_index = False
+
+# the number of rows written per bulk insert
+insert_chunk_size = 500
+
+# the number of rows read from the db per query when
+# streaming emails to redaction and transformation, and
+# whether to read the next page on a background thread
+stream_page_size = 500
+stream_prefetch = True
+
+# the number of emails per index page, and the number of
+# emails transformation reads from the db at once
+transform_page_size = 1000
+transform_batch_size = 500
+
+# the number of threads writing email body files
+files_workers = 4
+
+# shard email body files into subdirectories of this
+# many ids each, 0 keeps every file in one directory
+files_shard_size = 0
+
+# the maximum number of emails waiting between two
+# stages when running the redactor as a pipeline
+pipeline_queue_size = 100
+
+# write counters and timings for a run of the redactor to
+# this file, as Prometheus text if it ends in '.prom' and
+# as JSON otherwise, None to not write them
+metrics_file = None
+
+# profile a run of the redactor with cProfile, dumping the
+# stats to this file, None to not profile
+profile_file = None
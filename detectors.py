@@ -0,0 +1,191 @@
+"""
+The detectors module.
+
+A registry of the detectors run during redaction. Each
+detector declares its patterns, the email fields it
+applies to and a cheap prefilter, so its patterns are
+skipped for content that can't contain a match.
+
+Rule packs are modules with a DETECTORS list, named in
+the configured 'detector_packs', and are loaded the
+first time the registry is used.
+"""
+
+import config
+import importlib
+import re
+
+# the email fields detectors can apply to
+FIELDS = ('subject', 'email_from', 'email_to', 'body')
+
+class Detector(object):
+    """
+    A Detector.
+
+    Matches one kind of redactable content.
+    """
+
+    def __init__(self, name, patterns, fields, prefilter=None,
+                    excludable=False, crosses_tags=True):
+        """
+        Detector constructor.
+
+        Args:
+            name: the name of the detector, a valid python
+                identifier
+            patterns: list - the regex patterns to match
+            fields: tuple - the email fields to run the detector on
+            prefilter: callable taking some content and returning
+                False only if the patterns can't match it, or None
+                to always run the patterns
+            excludable: bool - whether matches containing one of
+                the configured 'excludes' are left as is
+            crosses_tags: bool - False if matches never contain a
+                '<' or '>' and the patterns don't look past the
+                match other than with word boundaries, so html
+                blocks can be redacted on their own
+        """
+        self.name = name
+        self.patterns = tuple(patterns)
+        self.fields = tuple(fields)
+        self.prefilter = prefilter
+        self.excludable = excludable
+        self.crosses_tags = crosses_tags
+
+        # compile the patterns now so a bad rule pack fails early
+        self.pattern = '|'.join(self.patterns)
+        re.compile(self.pattern)
+
+    def applies(self, content):
+        """
+        Check whether the detector could match some content.
+
+        Returns:
+            bool - False if the prefilter rules out any match
+        """
+        return self.prefilter is None or self.prefilter(content)
+
+def contains(*needles):
+    """
+    Build a prefilter passing content containing any of
+    the given strings.
+    """
+    def prefilter(content):
+        for needle in needles:
+            if needle in content:
+                return True
+
+        return False
+
+    return prefilter
+
+def searches(pattern):
+    """
+    Build a prefilter passing content where a regex
+    pattern is found.
+    """
+    search = re.compile(pattern).search
+
+    def prefilter(content):
+        return search(content) is not None
+
+    return prefilter
+
+# detector patterns
+PHONE_NUMBER_PATTERNS = [
+    r"\(?\d{3}\)?[.-]? *\d{3}[.-]? *[.-]?\d{4}",
+    r"\(\d{3}\)\s\d{3}-\d{4}",
+    r"\(\d{2,4}\)\d{6,7}",
+    r"\(\d{2,4}\) \d{6,7}",
+    r"^02[1579]\d{6,7}$",
+]
+
+EMAIL_ADDRESS_PATTERNS = [
+    r"[\w\.-]+@[\w\.-]+\.\w+",
+]
+
+IP_ADDRESS_PATTERNS = [
+    r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b",
+]
+
+# the built in detectors, in order of priority
+DETECTORS = [
+    Detector(
+        'email_address',
+        EMAIL_ADDRESS_PATTERNS,
+        fields=FIELDS,
+        prefilter=contains('@'),
+        excludable=True,
+        crosses_tags=False),
+    Detector(
+        'ip_address',
+        IP_ADDRESS_PATTERNS,
+        fields=('subject', 'body'),
+        prefilter=searches(r"\d\.\d"),
+        crosses_tags=False),
+    # it is unlikely that subjects will have phone numbers
+    # so we are not redacting phone numbers from the subject
+    Detector(
+        'phone_number',
+        PHONE_NUMBER_PATTERNS,
+        fields=('body',),
+        prefilter=searches(r"\d{4}"),
+        crosses_tags=False),
+]
+
+# the loaded detectors, in order of priority
+_registry = []
+
+def register(detector):
+    """
+    Add a detector to the registry.
+
+    A detector replaces any registered detector with the
+    same name, taking its priority, otherwise it has a lower
+    priority than every registered detector.
+
+    Args:
+        detector: Detector - the detector to add
+    """
+    for index, registered in enumerate(_registry):
+        if registered.name == detector.name:
+            _registry[index] = detector
+            return
+
+    _registry.append(detector)
+
+def registry():
+    """
+    Get the registered detectors, loading the built in
+    detectors and configured rule packs on first use.
+
+    Returns:
+        list - the detectors, in order of priority
+    """
+    if not _registry:
+        for detector in DETECTORS:
+            register(detector)
+
+        for pack in getattr(config, 'detector_packs', []):
+            for detector in importlib.import_module(pack).DETECTORS:
+                register(detector)
+
+    return _registry
+
+def named(names):
+    """
+    Get the registered detectors with the given names.
+
+    Returns:
+        list - the detectors, in order of priority
+    """
+    return [detector for detector in registry() if detector.name in names]
+
+def for_field(field):
+    """
+    Get the registered detectors that apply to an email field.
+
+    Returns:
+        list - the detectors, in order of priority
+    """
+    return [detector for detector in registry() if field in detector.fields]
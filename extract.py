@@ -8,9 +8,14 @@ Since: 10th Nov 2018
 import config
 import base64
 import email
+import metrics
 import models
+import random
+import threading
+import time
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from dateutil.parser import parse
 from googleapiclient import discovery
 from httplib2 import Http
@@ -18,19 +23,48 @@ from oauth2client import client, tools
 from oauth2client import file as ofile 
 from apiclient import errors
 
-def api_service():
+# http statuses that are retried with backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# the maximum number of requests in a gmail batch request
+MAX_BATCH_SIZE = 100
+
+# labels of messages that are left out of message lists
+EXCLUDED_LABELS = ('SPAM', 'TRASH')
+
+# the mime types of message parts that can be a body
+BODY_MIME_TYPES = ('text/plain', 'text/html')
+
+# the fields of the metadata pass in 'raw' format, the part
+# tree is only described down to METADATA_DEPTH levels
+METADATA_DEPTH = 3
+METADATA_FIELDS = ('id,threadId,internalDate,payload(headers,'
+                   'mimeType,filename,body/size,parts('
+                   'mimeType,filename,body/size,parts('
+                   'mimeType,filename,body/size)))')
+
+# the fields of the raw message
+RAW_FIELDS = 'id,raw'
+
+# the http status of messages deleted since they were listed
+NOT_FOUND = 404
+
+class HistoryExpired(Exception):
+    """
+    Raised when a history id is too old to list
+    the history from.
     """
-    Get the api service that will be used to extract the
-    information for redaction.
 
-    The api service method can be interchanged with a different
-    service if a different service is required to get the redactable
-    data.
+def api_http():
+    """
+    Get an authorized http object to make api calls with.
+
+    Http objects are not thread safe, so each thread making
+    api calls needs its own.
 
     Returns:
-    google_api_service
+    httplib2.Http
     """
-
     store = ofile.Storage(config.google_token)
     creds = store.get()
 
@@ -41,8 +75,22 @@ def api_service():
 
         creds = tools.run_flow(flow, store)
 
-    return discovery.build('gmail', 'v1', http=creds.authorize(Http()))
-    
+    return creds.authorize(Http())
+
+def api_service():
+    """
+    Get the api service that will be used to extract the
+    information for redaction.
+
+    The api service method can be interchanged with a different
+    service if a different service is required to get the redactable
+    data.
+
+    Returns:
+    google_api_service
+    """
+    return discovery.build('gmail', 'v1', http=api_http())
+
 class GMailExtractor(object):
     """
     The GMail Extractor.
@@ -52,14 +100,157 @@ class GMailExtractor(object):
     """
     _page_token = None
 
-    def __init__(self, service):
+    def __init__(self, service, http_factory=None, fetch_mode='serial',
+                    workers=8, batch_size=MAX_BATCH_SIZE, retries=5,
+                    message_format='full'):
         """
         GMail Extractor constructor.
 
         Sets the service to be used to make calls to the Gmail
         API.
+
+        Args:
+            service: the gmail api service
+            http_factory: callable returning a new http object, used
+                to give each thread its own http object
+            fetch_mode: how messages are fetched, one of 'serial',
+                'batch' or 'threads'
+            workers: the number of threads used in 'threads' mode,
+                which bounds the number of requests in flight
+            batch_size: the number of messages per batch request
+                in 'batch' mode
+            retries: the number of times a rate limited or failed
+                request is retried with backoff
+            message_format: 'full' to fetch each message's json part
+                tree, or 'raw' to fetch a partial response of its
+                headers and part tree, and then the raw mime of
+                only the messages with a body
         """
+        if fetch_mode not in ('serial', 'batch', 'threads'):
+            raise ValueError('Unknown fetch mode {}.'.format(fetch_mode))
+
+        if message_format not in ('full', 'raw'):
+            raise ValueError(
+                'Unknown message format {}.'.format(message_format))
+
+        if fetch_mode == 'threads' and http_factory is None:
+            raise ValueError('Threaded fetching requires an http_factory.')
+
         self._service = service
+        self._http_factory = http_factory
+        self._fetch_mode = fetch_mode
+        self._workers = workers
+        self._batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self._retries = retries
+        self._message_format = message_format
+        self._local = threading.local()
+        self._failed = []
+        self._list_failed = False
+
+    def _http(self):
+        """
+        Get the http object for the current thread.
+
+        Returns:
+            http: the thread's http object, or None to use
+                the service's own
+        """
+        if self._http_factory is None:
+            return None
+
+        if getattr(self._local, 'http', None) is None:
+            self._local.http = self._http_factory()
+
+        return self._local.http
+
+    def _fail(self, mail_id, error):
+        """
+        Record a message that could not be fetched, unless
+        it was deleted since it was listed.
+
+        Args:
+            mail_id: the message id from gmail
+            error: the error the fetch failed with
+        """
+        print(error)
+
+        if not isinstance(error, errors.HttpError) \
+                or error.resp.status != NOT_FOUND:
+            self._failed.append(mail_id)
+
+    def failed(self):
+        """
+        Get the messages that could not be listed or fetched.
+
+        Returns:
+            tuple - the ids of the messages that could not be
+                fetched, and whether listing messages failed
+        """
+        return list(self._failed), self._list_failed
+
+    def _backoff(self, attempt):
+        """
+        Sleep before retrying a request.
+
+        Args:
+            attempt: the number of attempts made so far
+        """
+        time.sleep(min(2 ** attempt, 32) + random.random())
+
+    def _execute(self, request):
+        """
+        Execute an api request, retrying with backoff when
+        rate limited or when the api fails.
+
+        Args:
+            request: the api request to execute
+
+        Returns:
+            response: the api response
+        """
+        attempt = 0
+
+        while True:
+            try:
+                return request.execute(http=self._http())
+
+            except errors.HttpError as e:
+                if e.resp.status not in RETRY_STATUSES \
+                        or attempt >= self._retries:
+                    raise
+
+            self._backoff(attempt)
+            attempt += 1
+
+    def _get_request(self, mail_id, user_id='me'):
+        """
+        Build the api request to get a full message.
+        """
+        return self._service.users().messages() \
+                    .get(userId=user_id, 
+                            format='full',
+                            id=mail_id)
+
+    def _metadata_request(self, mail_id, user_id='me'):
+        """
+        Build the api request to get a message's headers and
+        part tree, without any part data.
+        """
+        return self._service.users().messages() \
+                    .get(userId=user_id,
+                            format='full',
+                            id=mail_id,
+                            fields=METADATA_FIELDS)
+
+    def _raw_request(self, mail_id, user_id='me'):
+        """
+        Build the api request to get a message's raw mime.
+        """
+        return self._service.users().messages() \
+                    .get(userId=user_id,
+                            format='raw',
+                            id=mail_id,
+                            fields=RAW_FIELDS)
 
     def messages(self, user_id='me', query=''):
         """
@@ -75,12 +266,12 @@ class GMailExtractor(object):
         """
         try:
             if self.page_token():
-                response = self._service.users().messages() \
+                response = self._execute(self._service.users().messages() \
                                 .list(userId=user_id, q=query,
-                                        pageToken=self.page_token()).execute()
+                                        pageToken=self.page_token()))
             else:
-                response = self._service.users().messages() \
-                                .list(userId=user_id, q=query).execute()
+                response = self._execute(self._service.users().messages() \
+                                .list(userId=user_id, q=query))
 
             messages = []
             if 'messages' in response:
@@ -90,9 +281,120 @@ class GMailExtractor(object):
             return messages
 
         except errors.HttpError as e:
-            print(e) 
+            print(e)
+
+            # stop listing, the messages after this page are
+            # picked up by the next sync
+            self._list_failed = True
+            self._page_token = None
             return []
 
+    def pages(self, user_id='me', query='', prefetch=False):
+        """
+        Iterate over the pages of the email list.
+
+        Args:
+            user_id: (default 'me') The id of the user
+            query: a special gmail query that can be used to
+                filter the messages returned (i.e. emails)
+            prefetch: fetch the next page in the background while
+                the current page is being processed
+
+        Yields:
+            messages: list - the messages on each page
+        """
+        if prefetch and self._http_factory is None:
+            raise ValueError('Prefetching requires an http_factory.')
+
+        pool = ThreadPool(1) if prefetch else None
+        messages = self.messages(user_id, query)
+
+        try:
+            while True:
+                next_page = None
+
+                if pool and self.page_token():
+                    next_page = pool.apply_async(
+                                    self.messages, (user_id, query))
+
+                yield messages
+
+                if next_page is not None:
+                    messages = next_page.get()
+                elif self.page_token():
+                    messages = self.messages(user_id, query)
+                else:
+                    break
+
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def history_id(self, user_id='me'):
+        """
+        Get the current history id of the mailbox.
+
+        Returns:
+            history_id: string - the mailbox's current history id
+        """
+        profile = self._execute(
+                    self._service.users().getProfile(userId=user_id))
+
+        return profile['historyId']
+
+    def history(self, start_history_id, user_id='me'):
+        """
+        Get the messages added to the mailbox since a history id.
+
+        Args:
+            start_history_id: the history id to list the history from
+            user_id: (default 'me') The id of the user
+
+        Returns:
+            messages: list - the added messages, oldest first
+
+        Raises:
+            HistoryExpired: if the history id is no longer available
+        """
+        messages = []
+        seen = set()
+        page_token = None
+
+        while True:
+            try:
+                response = self._execute(self._service.users().history() \
+                                .list(userId=user_id,
+                                        startHistoryId=start_history_id,
+                                        historyTypes='messageAdded',
+                                        pageToken=page_token))
+
+            except errors.HttpError as e:
+                # gmail responds with a 404 when the history id
+                # is too old
+                if e.resp.status == 404:
+                    raise HistoryExpired(start_history_id)
+
+                raise
+
+            for history in response.get('history', []):
+                for added in history.get('messagesAdded', []):
+                    message = added['message']
+                    labels = message.get('labelIds', [])
+
+                    if message['id'] in seen \
+                            or any(label in labels
+                                    for label in EXCLUDED_LABELS):
+                        continue
+
+                    seen.add(message['id'])
+                    messages.append(message)
+
+            page_token = response.get('nextPageToken')
+
+            if not page_token:
+                return messages
+
     def page_token(self):
         """
         Get the GMail api page token for the next page
@@ -109,6 +411,8 @@ class GMailExtractor(object):
         Get the part which represents the body of the GMail
         message.
 
+        Nested multipart parts are searched too.
+
         Args:
             parts: list - a list of message parts
 
@@ -119,18 +423,223 @@ class GMailExtractor(object):
             "text/plain": "", 
             "text/html": ""
         }
+        pending = list(reversed(parts))
 
         # we only want plain text or html
         # we don't care about the other parts
-        for part in parts:
-            if mimes.get(part['mimeType'].strip()) is not None:
-                mimes[part['mimeType']] = part['body'].get('data')
+        while pending:
+            part = pending.pop()
+            mime = part['mimeType'].strip()
+
+            if mime.startswith('multipart'):
+                pending.extend(reversed(part.get('parts', [])))
+            elif mime in mimes and part['body'].get('data'):
+                mimes[mime] = part['body']['data']
 
         if mimes.get('text/html'):
             return mimes['text/html']
 
         return mimes['text/plain']
 
+    def has_body(self, part, depth=0):
+        """
+        Check whether a message's part tree, from the metadata
+        pass, has a part that can be its body.
+
+        Args:
+            part: dict - the payload or a part of the message
+            depth: the nesting level of the part
+
+        Returns:
+            bool - False if the message has no body
+        """
+        mime = part.get('mimeType', '').strip()
+
+        if mime in BODY_MIME_TYPES:
+            return bool(part.get('body', {}).get('size')) \
+                    and not part.get('filename')
+
+        if not mime.startswith('multipart'):
+            return False
+
+        # parts below the metadata depth aren't described
+        if depth >= METADATA_DEPTH - 1:
+            return True
+
+        return any(self.has_body(child, depth + 1)
+                    for child in part.get('parts', []))
+
+    def body_from_mime(self, raw):
+        """
+        Get the body of a raw mime message, walking nested
+        parts and decoding only the chosen part.
+
+        Args:
+            raw: the base64url encoded mime message
+
+        Returns:
+            unicode: the html body if there is one, otherwise
+                the plain text body, or None
+        """
+        message = email.message_from_string(
+                    base64.urlsafe_b64decode(raw.encode('ASCII')))
+        chosen = {}
+
+        for part in message.walk():
+            if part.is_multipart():
+                continue
+
+            disposition = part.get('Content-Disposition', '')
+
+            if part.get_content_type() in BODY_MIME_TYPES \
+                    and not disposition.strip().lower() \
+                                .startswith('attachment'):
+                chosen[part.get_content_type()] = part
+
+        part = chosen.get('text/html') or chosen.get('text/plain')
+
+        if part is None:
+            return None
+
+        payload = part.get_payload(decode=True)
+
+        if not payload:
+            return None
+
+        try:
+            return payload.decode(
+                        part.get_content_charset() or 'utf-8', 'replace')
+        except LookupError:
+            return payload.decode('utf-8', 'replace')
+
+    def _record(self, message, body):
+        """
+        Generate an email record from a message's headers and
+        its decoded body.
+        """
+        # dict to gather email information
+        meta = {
+            "Subject": True,
+            "From": True,
+            "To": True,
+            "Date": True,
+        }
+
+        for header in message['payload']['headers']:
+            if meta.get(header['name'], False):
+                meta[header['name'].lower()] = header['value']
+
+                del meta[header['name']]
+
+        # gmail provides the internal date as epoch ms
+        date = datetime.fromtimestamp(
+                    float(message['internalDate']) / 1000)
+
+        return {
+            'external_id': message['id'],
+            'thread_id': message['threadId'],
+            'body': body,
+            'email_to': meta.get('to', ''),
+            'email_from': meta.get('from', ''),
+            'subject': meta.get('subject', ''),
+            'time': date,
+        }
+
+    def parse_message(self, message):
+        """
+        Generate an email record from a full GMail message.
+
+        Args:
+            message: dict - the message, in the 'full' format
+
+        Returns:
+            dict: the Email column values, or None if the message
+                has no content
+        """
+        # lets check the partId of the actual content
+        mime = message['payload']['mimeType']
+
+        if mime.startswith('multipart'):
+            content = self.retrieve_from_parts(
+                        message['payload']['parts'])
+        else:
+            content = message['payload']['body'].get('data')
+
+        # don't continue to make email if no content
+        if not content:
+            return
+
+        body = base64.urlsafe_b64decode(
+                    content.encode('ASCII'))
+
+        return self._record(message, unicode(body, 'utf-8'))
+
+    def parse_raw(self, metadata, message):
+        """
+        Generate an email record from the metadata pass and
+        the raw format of a GMail message.
+
+        Args:
+            metadata: dict - the message's headers and part tree
+            message: dict - the message, in the 'raw' format
+
+        Returns:
+            dict: the Email column values, or None if the message
+                has no content
+        """
+        body = self.body_from_mime(message['raw'])
+
+        # don't continue to make email if no content
+        if not body:
+            return
+
+        return self._record(metadata, body)
+
+    def _fetch_one(self, mail_id, build, user_id='me'):
+        """
+        Fetch one message.
+
+        Args:
+            mail_id: the message id from gmail
+            build: the method building the request
+
+        Returns:
+            dict: the response, or None if it failed
+        """
+        try:
+            with metrics.timer('extract_fetch_seconds'):
+                return self._execute(build(mail_id, user_id))
+
+        except errors.HttpError as e:
+            self._fail(mail_id, e)
+
+    def generate_record(self, mail_id, user_id='me'):
+        """
+        Get all contents for an email and generate an
+        email record.
+
+        Args:
+            mail_id: the message id from gmail
+
+        Returns:
+            dict: the Email column values, or None
+        """
+        if self._message_format == 'full':
+            message = self._fetch_one(mail_id, self._get_request, user_id)
+
+            if message:
+                return self.parse_message(message)
+
+            return
+
+        metadata = self._fetch_one(mail_id, self._metadata_request, user_id)
+
+        if metadata and self.has_body(metadata['payload']):
+            message = self._fetch_one(mail_id, self._raw_request, user_id)
+
+            if message:
+                return self.parse_raw(metadata, message)
+
     def generate_email(self, mail_id, thread_id, user_id='me'):
         """
         Using the mail_id and thread_id, get all contents for the
@@ -143,104 +652,389 @@ class GMailExtractor(object):
         Returns:
             Email: an email model
         """
+        record = self.generate_record(mail_id, user_id)
+
+        if record:
+            return models.Email(**record)
+
+    def _fetch_batch(self, mail_ids, build, user_id='me'):
+        """
+        Fetch messages using gmail batch requests.
+
+        Messages that are rate limited or fail are retried
+        in a later batch with backoff.
+
+        Args:
+            mail_ids: list - the ids of the messages to fetch
+            build: the method building each request
+
+        Returns:
+            responses: list - the responses, in message order,
+                with None for messages that could not be fetched
+        """
+        responses = {}
+        pending = list(mail_ids)
+        attempt = 0
+
+        while pending:
+            retry = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    responses[request_id] = response
+                elif isinstance(exception, errors.HttpError) \
+                        and exception.resp.status in RETRY_STATUSES \
+                        and attempt < self._retries:
+                    retry.append(request_id)
+                else:
+                    self._fail(request_id, exception)
+
+            for start in range(0, len(pending), self._batch_size):
+                ids = pending[start:start + self._batch_size]
+                batch = self._service.new_batch_http_request(
+                            callback=callback)
+
+                for mail_id in ids:
+                    batch.add(build(mail_id, user_id), request_id=mail_id)
+
+                try:
+                    with metrics.timer('extract_batch_seconds'):
+                        batch.execute(http=self._http())
+                except errors.HttpError as e:
+                    if e.resp.status not in RETRY_STATUSES \
+                            or attempt >= self._retries:
+                        raise
+
+                    retry.extend(mail_id for mail_id in ids
+                                    if mail_id not in responses)
+
+            if retry:
+                self._backoff(attempt)
+
+            pending = retry
+            attempt += 1
+
+        return [responses.get(mail_id) for mail_id in mail_ids]
+
+    def _fetch_threaded(self, mail_ids, build, user_id='me'):
+        """
+        Fetch messages on a pool of threads.
+
+        Args:
+            mail_ids: list - the ids of the messages to fetch
+            build: the method building each request
+
+        Returns:
+            responses: list - the responses, in message order,
+                with None for messages that could not be fetched
+        """
+        def fetch(mail_id):
+            return self._fetch_one(mail_id, build, user_id)
+
+        pool = ThreadPool(self._workers)
+
         try:
-            # dict to gather email information
-            meta = {
-                "Subject": True,
-                "From": True,
-                "To": True,
-                "Date": True,
-            }
-
-            message = self._service.users().messages() \
-                        .get(userId=user_id, 
-                                format='full',
-                                id=mail_id).execute()
-
-            # lets check the partId of the actual content
-            mime = message['payload']['mimeType']
+            return pool.map(fetch, mail_ids)
+        finally:
+            pool.close()
+            pool.join()
 
-            if mime.startswith('multipart'):
-                content = self.retrieve_from_parts(
-                            message['payload']['parts'])
-            else:
-                content = message['payload']['body']['data']
+    def _fetch(self, mail_ids, build, user_id='me'):
+        """
+        Fetch messages using the extractor's fetch mode.
 
-            # don't continue to make email if no content
-            if not content:
-                return
+        Returns:
+            responses: list - the responses, in message order,
+                with None for messages that could not be fetched
+        """
+        if not mail_ids:
+            return []
 
-            body = base64.urlsafe_b64decode(
-                        content.encode('ASCII'))
+        if self._fetch_mode == 'batch':
+            return self._fetch_batch(mail_ids, build, user_id)
 
-            for header in message['payload']['headers']:
-                if meta.get(header['name'], False):
-                    meta[header['name'].lower()] = header['value']
+        if self._fetch_mode == 'threads':
+            return self._fetch_threaded(mail_ids, build, user_id)
 
-                    del meta[header['name']]
+        return [self._fetch_one(mail_id, build, user_id)
+                    for mail_id in mail_ids]
 
-            # gmail provides the internal date as epoch ms
-            date = datetime.fromtimestamp(
-                        float(message['internalDate']) / 1000)
+    def generate_records(self, messages, user_id='me'):
+        """
+        Generate email records for a list of messages, using
+        the extractor's fetch mode and message format.
 
-            return models.Email(
-                        external_id=message['id'],
-                        thread_id=message['threadId'],
-                        body=unicode(body, 'utf-8'),
-                        email_to=meta.get('to', ''),
-                        email_from=meta.get('from', ''),
-                        subject=meta.get('subject', ''),
-                        time=date
-                    )
+        Args:
+            messages: list - the messages to fetch
 
-        except errors.HttpError as e:
-            print(e)
+        Returns:
+            records: list - the email records, in message order,
+                with None for messages that have no content or
+                could not be fetched
+        """
+        metrics.incr('extract_messages_total', len(messages))
+        mail_ids = [message['id'] for message in messages]
 
-def extract_messages(extractor, messages):
+        with metrics.timer('extract_page_seconds', mode=self._fetch_mode):
+            if self._message_format == 'full':
+                return [self.parse_message(message) if message else None
+                            for message in self._fetch(
+                                mail_ids, self._get_request, user_id)]
+
+            # only fetch the raw mime of messages with a body
+            metadata = self._fetch(mail_ids, self._metadata_request, user_id)
+            wanted = [item['id'] for item in metadata
+                        if item and self.has_body(item['payload'])]
+            raw = dict(zip(wanted, self._fetch(
+                                wanted, self._raw_request, user_id)))
+
+            metrics.incr('extract_raw_skipped_total',
+                            len(mail_ids) - len(wanted))
+
+            return [self.parse_raw(item, raw[item['id']])
+                        if item and raw.get(item['id']) else None
+                            for item in metadata]
+
+def latest(*times):
     """
-    Extract the given messages into the db.
+    Get the latest of some times, ignoring missing times.
+
+    Returns:
+        datetime: the latest time, or None if all are missing
+    """
+    times = [value for value in times if value is not None]
+    return max(times) if times else None
+
+def new_records(extractor, messages, session=None):
+    """
+    Generate email records for the given messages that are
+    not in the db yet.
 
     Args:
         extractor: object - the extractor to use to extract the messages
-        messages: list - a list of messages to store in the db
+        messages: list - a list of messages
+        session: the db session to check with, defaults to
+            the global session
+
+    Returns:
+        records: list - the Email column values of the new emails
     """
-    session = models.db_session()
+    session = session or models.db_session()
     ids = [message['id'] for message in messages]
     existing = session.query(models.Email.external_id) \
                 .filter(models.Email.external_id.in_(ids)) \
                 .all()
-    existing_ids = [item[0] for item in existing] 
+    existing_ids = set(item[0] for item in existing)
+
+    # if we already have this message in the db
+    # we don't need to recreate it
+    messages = [message for message in messages
+                    if message['id'] not in existing_ids]
+
+    return [record for record in extractor.generate_records(messages)
+                if record]
+
+def extract_messages(extractor, messages, session=None):
+    """
+    Extract the given messages into the db.
+
+    Args:
+        extractor: object - the extractor to use to extract the messages
+        messages: list - a list of messages to store in the db
+        session: the db session to write with, defaults to
+            the shared session
+
+    Returns:
+        newest: datetime - the time of the newest email stored,
+            or None if no emails were stored
+    """
+    session = session or models.db_session()
+    records = new_records(extractor, messages, session)
+
+    # write the records
+    models.bulk_insert(models.Email, records, session=session)
+
+    return latest(*[record['time'] for record in records])
+
+def load_checkpoint(session, query):
+    """
+    Get the sync checkpoint for a query.
+
+    Args:
+        session: the db session
+        query: the gmail query
 
-    for message in messages:
-        # if we already have this message in the db
-        # we don't need to recreate it
-        if message['id'] in existing_ids:
-            continue
+    Returns:
+        SyncCheckpoint: the checkpoint, or None if the query
+            has not been synced yet
+    """
+    return session.query(models.SyncCheckpoint) \
+                .filter(models.SyncCheckpoint.query == query) \
+                .first()
 
-        email = extractor.generate_email(
-                    message['id'], message['threadId'])
+def save_checkpoint(session, query, history_id, newest):
+    """
+    Store the sync checkpoint for a query after a sync.
 
-        if not email:
-            continue
+    Args:
+        session: the db session
+        query: the gmail query
+        history_id: the mailbox history id from before the sync
+        newest: datetime - the time of the newest email stored
+            during the sync
+    """
+    checkpoint = load_checkpoint(session, query)
 
-        session.add(email)
+    if not checkpoint:
+        checkpoint = models.SyncCheckpoint(query=query)
+        session.add(checkpoint)
 
-    # commit the records
+    checkpoint.history_id = history_id
+    checkpoint.high_water = latest(checkpoint.high_water, newest)
+    checkpoint.time = datetime.now()
     session.commit()
 
+def finish_sync(extractor, session, query, history_id, newest):
+    """
+    Store the sync checkpoint for a query, unless some
+    messages could not be listed or fetched, so the next
+    sync lists them again.
+
+    Args:
+        extractor: object - the extractor the sync was made with
+        session: the db session
+        query: the gmail query
+        history_id: the mailbox history id from before the sync
+        newest: datetime - the time of the newest email stored
+            during the sync
+
+    Returns:
+        bool - whether the checkpoint was stored
+    """
+    mail_ids, list_failed = extractor.failed()
+
+    if mail_ids or list_failed:
+        print('{} messages failed{}, keeping the checkpoint.'.format(
+                len(mail_ids), ' and listing failed' if list_failed else ''))
+        return False
+
+    save_checkpoint(session, query, history_id, newest)
+    return True
+
+def incremental_pages(extractor, checkpoint, query):
+    """
+    Get the pages of messages added since a sync checkpoint.
+
+    The history can't be filtered by a gmail query, so
+    queries are listed from the checkpoint's high water
+    mark instead.
+
+    Args:
+        extractor: object - the extractor to list messages with
+        checkpoint: SyncCheckpoint - the last sync checkpoint
+        query: the gmail query
+
+    Returns:
+        pages: iterable of message lists
+
+    Raises:
+        HistoryExpired: if the checkpoint's history is no
+            longer available
+    """
+    if query:
+        if not checkpoint.high_water:
+            raise HistoryExpired(checkpoint.history_id)
+
+        after = int(time.mktime(checkpoint.high_water.timetuple()))
+
+        return extractor.pages(
+                    query='{} after:{}'.format(query, after),
+                    prefetch=getattr(config, 'gmail_prefetch_pages', False))
+
+    messages = extractor.history(checkpoint.history_id)
+
+    return [messages[start:start + MAX_BATCH_SIZE]
+                for start in range(0, len(messages), MAX_BATCH_SIZE)]
+
+def build_extractor():
+    """
+    Build the GMail extractor using the config.
+
+    Returns:
+        GMailExtractor: the extractor
+    """
+    return GMailExtractor(
+                api_service(),
+                http_factory=api_http,
+                fetch_mode=getattr(config, 'gmail_fetch_mode', 'serial'),
+                workers=getattr(config, 'gmail_fetch_workers', 8),
+                batch_size=getattr(
+                    config, 'gmail_batch_size', MAX_BATCH_SIZE),
+                message_format=getattr(
+                    config, 'gmail_message_format', 'full'))
+
+def sync_pages(extractor, session, query):
+    """
+    Get the pages of messages to extract for a query.
+
+    Only messages added since the last sync checkpoint are
+    listed, falling back to listing every message when
+    there is no checkpoint or its history has expired.
+
+    Args:
+        extractor: object - the extractor to list messages with
+        session: the db session
+        query: the gmail query
+
+    Returns:
+        tuple - the (history_id, pages) of the sync, where the
+            history id is to be saved in the checkpoint once
+            the pages are extracted
+    """
+    # take the history id before listing, so messages added
+    # during the sync are picked up by the next one
+    history_id = extractor.history_id()
+    checkpoint = load_checkpoint(session, query)
+
+    if checkpoint and checkpoint.history_id:
+        try:
+            pages = incremental_pages(extractor, checkpoint, query)
+            print('Extracting from history {}.'.format(
+                    checkpoint.history_id))
+
+            return history_id, pages
+
+        except HistoryExpired:
+            print('History {} expired, extracting all messages.'.format(
+                    checkpoint.history_id))
+
+    pages = extractor.pages(
+                query=query,
+                prefetch=getattr(config, 'gmail_prefetch_pages', False))
+
+    return history_id, pages
+
 def run():
     """
     Run extraction.
     """
-    extractor = GMailExtractor(api_service())
-    messages = extractor.messages(query=config.gmail_query)
-    print('Extracting first page.')
-    extract_messages(extractor, messages)
+    session = models.new_session()
+    query = config.gmail_query
+    extractor = build_extractor()
+
+    try:
+        history_id, pages = sync_pages(extractor, session, query)
+        newest = None
+
+        for number, messages in enumerate(pages, 1):
+            print('Extracting page {}.'.format(number))
+            newest = latest(newest,
+                        extract_messages(extractor, messages, session))
+
+        finish_sync(extractor, session, query, history_id, newest)
 
-    while extractor.page_token():
-        print('Extracting page {}.'.format(extractor.page_token()))
-        messages = extractor.messages(query=config.gmail_query)
-        extract_messages(extractor, messages)
+    finally:
+        session.close()
 
 if __name__ == '__main__':
     run()
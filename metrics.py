@@ -0,0 +1,210 @@
+"""
+The metrics module.
+
+Counters and timing histograms for instrumenting the
+redactor, which can be exported to a JSON or Prometheus
+text file.
+
+Metrics are kept per process, so metrics recorded in
+worker processes are not included.
+"""
+
+import cProfile
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+# the upper bounds of the timing histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0,
+           float('inf'))
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+def _key(name, labels):
+    """
+    Get the key of a metric with labels.
+    """
+    return name, tuple(sorted(labels.items()))
+
+def incr(name, value=1, **labels):
+    """
+    Increment a counter.
+
+    Args:
+        name: the name of the counter
+        value: the amount to increment by
+        labels: the labels of the counter
+    """
+    key = _key(name, labels)
+
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    """
+    Record a timing in a histogram.
+
+    Args:
+        name: the name of the histogram
+        seconds: the time taken
+        labels: the labels of the histogram
+    """
+    key = _key(name, labels)
+
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = {
+                'count': 0,
+                'sum': 0.0,
+                'buckets': [0] * len(BUCKETS),
+            }
+
+        histogram = _histograms[key]
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+                break
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Time the code run in the context into a histogram.
+
+    Args:
+        name: the name of the histogram
+        labels: the labels of the histogram
+    """
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+def reset():
+    """
+    Clear all metrics.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def snapshot():
+    """
+    Get the current metrics.
+
+    Returns:
+        dict - the counters and histograms, with their labels
+    """
+    with _lock:
+        counters = [
+            {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(_counters.items())
+        ]
+
+        histograms = []
+
+        for (name, labels), histogram in sorted(_histograms.items()):
+            cumulative = 0
+            buckets = []
+
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                buckets.append(['+Inf' if bound == float('inf')
+                                    else repr(bound), cumulative])
+
+            histograms.append({
+                'name': name,
+                'labels': dict(labels),
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'buckets': buckets,
+            })
+
+    return {'counters': counters, 'histograms': histograms}
+
+def _labels(labels, **extra):
+    """
+    Format labels in the Prometheus text format.
+    """
+    labels = sorted(dict(labels, **extra).items())
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(key, value)
+                            for key, value in labels) + '}'
+
+def prometheus():
+    """
+    Get the current metrics in the Prometheus text format.
+
+    Returns:
+        string - the metrics
+    """
+    metrics = snapshot()
+    lines = []
+
+    for counter in metrics['counters']:
+        lines.append('{}{} {}'.format(
+            counter['name'], _labels(counter['labels']), counter['value']))
+
+    for histogram in metrics['histograms']:
+        name = histogram['name']
+        labels = histogram['labels']
+
+        for bound, count in histogram['buckets']:
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(labels, le=bound), count))
+
+        lines.append('{}_sum{} {}'.format(
+            name, _labels(labels), histogram['sum']))
+        lines.append('{}_count{} {}'.format(
+            name, _labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+def export(path):
+    """
+    Export the current metrics to a file.
+
+    Files ending in '.prom' are written in the Prometheus
+    text format, anything else as JSON.
+
+    Args:
+        path: the path of the file to write
+    """
+    with open(path, 'w') as f:
+        if path.endswith('.prom'):
+            f.write(prometheus())
+        else:
+            json.dump(snapshot(), f, indent=2, sort_keys=True)
+
+@contextmanager
+def profiled(path):
+    """
+    Profile the code run in the context with cProfile.
+
+    Args:
+        path: the file to dump the profile stats to, or
+            a false value to not profile
+    """
+    if not path:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
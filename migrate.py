@@ -1,23 +1,43 @@
 """
 Run migrations to create models.
 """
-import os
+import argparse
 import config
 import models
-from sqlalchemy import create_engine, Index
-from sqlalchemy.orm import sessionmaker
+import search
 
-# file's directory
-PWD = os.path.dirname(os.path.realpath(__file__))
+parser = argparse.ArgumentParser(description='Run migrations.')
+parser.add_argument(
+    '--rewrite-bodies', action='store_true',
+    help='rewrite stored bodies with the configured body_compression')
+parser.add_argument(
+    '--vacuum', action='store_true',
+    help='reclaim the space freed by rewriting bodies')
+args = parser.parse_args()
 
-# create the engine
-engine = create_engine(
-            'sqlite:///{}/{}'.format(PWD, config.sqlite_file),
-            echo=True)
+# use the models' engine, so the db gets the same sqlite pragmas
+engine = models.db_engine()
+engine.echo = True
 
-# migrate the db tables
+# migrate the db tables and their indexes
+# existing tables and indexes are left as they are
 models.Base.metadata.create_all(engine)
 
-# add index for external_id
-external_id_index = Index('external_id_index', models.Email.external_id)
-external_id_index.create(bind=engine)
+if search.enabled():
+    search.create(engine)
+
+if args.rewrite_bodies:
+    engine.echo = False
+    session = models.new_session()
+
+    try:
+        for model in (models.Email, models.RedactedEmail):
+            count = models.rewrite_bodies(model, session=session)
+            print('Rewrote {} {} bodies with {} compression.'.format(
+                count, model.__tablename__,
+                getattr(config, 'body_compression', None) or 'no'))
+    finally:
+        session.close()
+
+if args.vacuum:
+    engine.execute('VACUUM')
@@ -9,16 +9,64 @@ Since: 10th Nov 2018
 
 import os
 import config
-from sqlalchemy import create_engine
+import metrics
+import threading
+import zlib
+from itertools import islice
+from Queue import Queue, Full
+from sqlalchemy import create_engine, event, and_, bindparam, exists, select
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy import Column, Integer, String, DateTime, Index
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # file's directory
 PWD = os.path.dirname(os.path.realpath(__file__))
 
+# the sqlite pragmas applied to each connection, overridden
+# by the configured 'sqlite_pragmas'
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 30000,
+}
+
+def sqlite_engine(path, **kwargs):
+    """
+    Create an engine for a sqlite file, applying the
+    sqlite pragmas to each new connection.
+
+    Args:
+        path: the path of the sqlite file
+        kwargs: extra arguments for create_engine
+
+    Returns:
+        engine: the db engine
+    """
+    new_engine = create_engine('sqlite:///{}'.format(path), **kwargs)
+    pragmas = dict(SQLITE_PRAGMAS, **getattr(config, 'sqlite_pragmas', {}))
+
+    @event.listens_for(new_engine, 'connect')
+    def apply_pragmas(connection, record):
+        cursor = connection.cursor()
+
+        for name, value in sorted(pragmas.items()):
+            if value is not None:
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+        cursor.close()
+
+    return new_engine
+
 # create the engine
-engine = create_engine('sqlite:///{}/{}'.format(PWD, config.sqlite_file))
+engine = sqlite_engine(os.path.join(PWD, config.sqlite_file))
 
 # create a db session
 Session = sessionmaker(bind=engine)
@@ -29,28 +77,453 @@ Base = declarative_base()
 
 def db_session():
     """
-    Get a db session.
+    Get the shared db session.
     """
     return session
 
+def new_session():
+    """
+    Create a db session of its own for a stage, so stages
+    don't share a connection. Close it when done.
+    """
+    return Session()
+
 def db_engine():
     """
     Get the db engine.
     """
     return engine
 
+def bind(new_engine):
+    """
+    Bind the models to another db engine, such as
+    a scratch db.
+
+    Args:
+        new_engine: the db engine to use from now on
+    """
+    global engine, session
+
+    engine = new_engine
+    Session.configure(bind=engine)
+    session = Session()
+
+def _records(table, rows):
+    """
+    Convert rows to dicts keyed by column name.
+
+    Tuples are taken to be in the table's column order.
+    """
+    keys = table.columns.keys()
+
+    for row in rows:
+        if isinstance(row, dict):
+            yield row
+        else:
+            yield dict(zip(keys, row))
+
+def _upsert_statements(table, keys, columns):
+    """
+    Build the statements that upsert rows on key columns.
+
+    Existing rows are updated and missing rows are inserted,
+    so the key columns do not need a unique index.
+
+    Args:
+        table: the table to upsert into
+        keys: tuple - the names of the columns to upsert on
+        columns: list - the names of the columns being written
+
+    Returns:
+        tuple - the (update, insert) statements, with
+            parameters prefixed by '_u_' and '_i_' respectively
+    """
+    primary_keys = table.primary_key.columns.keys()
+
+    update = table.update() \
+                .where(and_(*[table.c[key] == bindparam('_u_' + key)
+                                for key in keys])) \
+                .values(dict((column, bindparam('_u_' + column))
+                                for column in columns
+                                    if column not in keys
+                                        and column not in primary_keys))
+
+    values = select([bindparam('_i_' + column, type_=table.c[column].type)
+                        for column in columns]) \
+                .where(~exists().where(and_(*[
+                        table.c[key] == bindparam(
+                            '_i_' + key, type_=table.c[key].type)
+                                for key in keys])))
+
+    insert = table.insert().from_select(columns, values)
+    return update, insert
+
+def bulk_insert(model, rows, chunk_size=None, upsert_on=None, session=None,
+                    after_chunk=None):
+    """
+    Write rows for a model with executemany, in chunks.
+
+    Each chunk is committed as it is written, so rows
+    can be streamed from a generator.
+
+    Args:
+        model: the model class to write rows for
+        rows: iterable of dicts keyed by column name, or of
+            tuples in the table's column order
+        chunk_size: the number of rows per executemany, defaults
+            to the configured 'insert_chunk_size'
+        upsert_on: the name, or tuple of names, of the columns to
+            upsert on, rows with matching values are updated
+            instead of inserted
+        session: the db session to write with, defaults to
+            the global session
+        after_chunk: callable taking the session and each chunk of
+            dicts, run before the chunk is committed, so other
+            tables can be written in the same transaction. Keys
+            that aren't columns of the table are left out of the
+            write but passed on to it
+
+    Returns:
+        int - the number of rows written
+    """
+    table = model.__table__
+    session = session or db_session()
+    chunk_size = chunk_size or getattr(config, 'insert_chunk_size', 500)
+    records = _records(table, rows)
+    names = set(table.columns.keys())
+    count = 0
+
+    if isinstance(upsert_on, basestring):
+        upsert_on = (upsert_on,)
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+
+        if not chunk:
+            break
+
+        columns = [column for column in chunk[0] if column in names]
+        values = chunk
+
+        if len(columns) < len(chunk[0]):
+            values = [dict((column, record[column]) for column in columns)
+                        for record in chunk]
+
+        if upsert_on:
+            update, insert = _upsert_statements(table, upsert_on, columns)
+
+            session.execute(update, [
+                dict(('_u_' + column, record[column])
+                        for column in columns) for record in values])
+            session.execute(insert, [
+                dict(('_i_' + column, record[column])
+                        for column in columns) for record in values])
+        else:
+            session.execute(table.insert(), values)
+
+        if after_chunk is not None:
+            after_chunk(session, chunk)
+
+        with metrics.timer('db_commit_seconds', table=table.name):
+            session.commit()
+
+        metrics.incr('db_rows_written_total', len(chunk), table=table.name)
+        count += len(chunk)
+
+    return count
+
+# marks the end of a stream's pages
+_END = object()
+
+def _pages(build, key, page_size):
+    """
+    Read the pages of a keyset paginated query on a
+    session of its own.
+    """
+    session = new_session()
+    last = None
+
+    try:
+        while True:
+            query = build(session)
+
+            if last is not None:
+                query = query.filter(key > last)
+
+            rows = query.order_by(key.asc()).limit(page_size).all()
+
+            if not rows:
+                return
+
+            yield [tuple(row) for row in rows]
+            last = rows[-1][0]
+
+    finally:
+        session.close()
+
+def _prefetch(pages):
+    """
+    Read pages on a background thread, one page ahead of
+    the pages being used.
+    """
+    queue = Queue(1)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def read():
+        try:
+            for page in pages:
+                if not put(page):
+                    break
+            else:
+                put(_END)
+
+        except Exception as e:
+            put(e)
+
+        finally:
+            # close the page session on the thread that opened it
+            pages.close()
+
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            page = queue.get()
+
+            if page is _END:
+                return
+
+            if isinstance(page, Exception):
+                raise page
+
+            yield page
+
+    finally:
+        stopped.set()
+
+def stream(build, key, page_size=None, prefetch=None):
+    """
+    Stream the rows of a query with keyset pagination.
+
+    Pages are read on a session of the stream's own, with
+    the whole page read before it is used, so committing
+    while streaming never resets an open cursor.
+
+    Args:
+        build: callable taking a session and returning the query
+            to stream, whose first column must be the key
+        key: the column to paginate on, unique and indexed
+        page_size: the number of rows per page, defaults to
+            the configured 'stream_page_size'
+        prefetch: read the next page on a background thread while
+            the current one is used, defaults to the configured
+            'stream_prefetch'
+
+    Yields:
+        tuple - the values of each row, in key order
+    """
+    page_size = page_size or getattr(config, 'stream_page_size', 500)
+
+    if prefetch is None:
+        prefetch = getattr(config, 'stream_prefetch', True)
+
+    pages = _pages(build, key, page_size)
+
+    if prefetch:
+        pages = _prefetch(pages)
+
+    for page in pages:
+        for row in page:
+            yield row
+
+def rewrite_bodies(model, batch_size=500, session=None):
+    """
+    Rewrite the bodies of a model in place, compressing them
+    with the configured 'body_compression', or storing them
+    as plain text when it is off.
+
+    Args:
+        model: the model class to rewrite the bodies of
+        batch_size: the number of rows rewritten per commit
+        session: the db session to write with, defaults to
+            the shared session
+
+    Returns:
+        int - the number of rows rewritten
+    """
+    table = model.__table__
+    session = session or db_session()
+    update = table.update() \
+                .where(table.c.id == bindparam('_id')) \
+                .values(body=bindparam('_body', type_=table.c.body.type))
+    base_id = 0
+    count = 0
+
+    while True:
+        # read the whole batch, commits reset open sqlite cursors
+        rows = session.execute(
+                    select([table.c.id, table.c.body]) \
+                        .where(table.c.id > base_id) \
+                        .order_by(table.c.id) \
+                        .limit(batch_size)).fetchall()
+
+        if not rows:
+            break
+
+        session.execute(update, [{'_id': row[0], '_body': row[1]}
+                                    for row in rows])
+        session.commit()
+
+        base_id = rows[-1][0]
+        count += len(rows)
+
+    return count
+
+# starts compressed values, followed by a codec byte, plain
+# text never starts with a NUL
+COMPRESSED_MAGIC = '\0'
+
+# the zstd compressors and decompressors of each thread
+_zstd = threading.local()
+
+def _zstd_codec(kind):
+    """
+    Get the current thread's zstd compressor or decompressor,
+    using the configured 'body_compression_dictionary'.
+    """
+    codec = getattr(_zstd, kind, None)
+
+    if codec is None:
+        if zstandard is None:
+            raise RuntimeError('zstd compression needs the '
+                                'zstandard package installed.')
+
+        path = getattr(config, 'body_compression_dictionary', None)
+        options = {}
+
+        if path:
+            with open(path, 'rb') as f:
+                options['dict_data'] = zstandard.ZstdCompressionDict(
+                                        f.read())
+
+        if kind == 'compressor':
+            codec = zstandard.ZstdCompressor(
+                        level=getattr(config, 'body_compression_level', 3),
+                        **options)
+        else:
+            codec = zstandard.ZstdDecompressor(**options)
+
+        setattr(_zstd, kind, codec)
+
+    return codec
+
+def compress(text, codec):
+    """
+    Compress some text.
+
+    Args:
+        text: the text to compress
+        codec: 'zlib' or 'zstd'
+
+    Returns:
+        string - the magic prefix, the codec byte and the
+            compressed utf8 text
+    """
+    data = text.encode('utf8') if isinstance(text, unicode) else text
+
+    if codec == 'zlib':
+        return COMPRESSED_MAGIC + 'z' + zlib.compress(
+                data, getattr(config, 'body_compression_level', 6))
+
+    if codec == 'zstd':
+        return COMPRESSED_MAGIC + 's' + \
+                _zstd_codec('compressor').compress(data)
+
+    raise ValueError('unknown body compression {}.'.format(codec))
+
+def decompress(value):
+    """
+    Decompress a value written by compress, passing any
+    other text through.
+
+    Returns:
+        unicode - the text
+    """
+    if isinstance(value, unicode):
+        return value
+
+    data = str(value)
+
+    if not data.startswith(COMPRESSED_MAGIC):
+        return data.decode('utf8')
+
+    if data[1] == 'z':
+        data = zlib.decompress(data[2:])
+    elif data[1] == 's':
+        data = _zstd_codec('decompressor').decompress(data[2:])
+    else:
+        raise ValueError('unknown compressed value.')
+
+    return data.decode('utf8')
+
+class CompressedText(TypeDecorator):
+    """
+    A text column stored compressed with the configured
+    'body_compression', and decompressed on access.
+
+    Values are stored as plain text when compression is
+    off or doesn't make them smaller, so columns can hold
+    both and be converted in place.
+    """
+    impl = String
+
+    def process_bind_param(self, value, dialect):
+        codec = getattr(config, 'body_compression', None)
+
+        if value is None or not codec:
+            return value
+
+        compressed = compress(value, codec)
+
+        if len(compressed) >= len(value):
+            return value
+
+        # sqlite stores buffers as blobs
+        return buffer(compressed)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+
+        return decompress(value)
+
 class Email(Base):
     """
     The Email model. Stores emails.
     """
     __tablename__ = 'emails'
+    __table_args__ = (
+        Index('external_id_index', 'external_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     subject = Column(String)
     email_from = Column(String)
     email_to = Column(String)
     time = Column(DateTime)
-    body = Column(String)
+    body = Column(CompressedText)
     external_id = Column(String)
     thread_id = Column(String)
 
@@ -65,6 +538,88 @@ class RedactedEmail(Base):
     email_from = Column(String)
     email_to = Column(String)
     time = Column(DateTime)
-    body = Column(String)
+    body = Column(CompressedText)
     external_id = Column(String)
     thread_id = Column(String)
+
+class SyncCheckpoint(Base):
+    """
+    The Sync Checkpoint model. Stores how far extraction
+    has synced the emails for a query.
+    """
+    __tablename__ = 'sync_checkpoints'
+
+    id = Column(Integer, primary_key=True)
+    query = Column(String, unique=True)
+    history_id = Column(String)
+    high_water = Column(DateTime)
+    time = Column(DateTime)
+
+class GeneratedFile(Base):
+    """
+    The Generated File model. Stores the content hash of
+    each email body file written by transformation.
+    """
+    __tablename__ = 'generated_files'
+
+    email_type = Column(String, primary_key=True)
+    email_id = Column(Integer, primary_key=True)
+    path = Column(String)
+    digest = Column(String)
+
+class GeneratedPage(Base):
+    """
+    The Generated Page model. Stores the id range and the
+    content hash of each index page written by transformation.
+    """
+    __tablename__ = 'generated_pages'
+
+    email_type = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+    first_id = Column(Integer)
+    last_id = Column(Integer)
+    digest = Column(String)
+
+class RedactionPolicy(Base):
+    """
+    The Redaction Policy model. Stores the detectors, excludes
+    and redaction string that entity spans were recorded with.
+    """
+    __tablename__ = 'redaction_policies'
+
+    id = Column(Integer, primary_key=True)
+    detectors = Column(String)
+    redaction_string = Column(String)
+    excludes = Column(String)
+    time = Column(DateTime)
+
+class SpanScan(Base):
+    """
+    The Span Scan model. Stores the policy the entity spans
+    of each redacted email were recorded with, and the policy
+    they were last applied with.
+    """
+    __tablename__ = 'span_scans'
+
+    email_id = Column(Integer, primary_key=True)
+    scan_policy_id = Column(Integer)
+    policy_id = Column(Integer, index=True)
+
+class EntitySpan(Base):
+    """
+    The Entity Span model. Stores where each detector matched
+    in the fields of the redacted emails.
+    """
+    __tablename__ = 'entity_spans'
+    __table_args__ = (
+        Index('entity_spans_detector_domain_index', 'detector', 'domain'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, index=True)
+    field = Column(String)
+    detector = Column(String)
+    start = Column(Integer)
+    end = Column(Integer)
+    value_hash = Column(String)
+    domain = Column(String)
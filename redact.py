@@ -5,50 +5,566 @@ Author: Anirvan Bhaduri
 Since: 10th Nov 2018
 """
 
+import argparse
+import cache
 import config
+import detectors
+import json
+import metrics
 import models
+import multiprocessing
+import os
 import sys
 import re
+import search
+import spans
+import threading
 import traceback
+import transform
+from bisect import bisect_right
+from cachetools import LRUCache
+from itertools import islice
+from sqlalchemy import bindparam
 from HTMLParser import HTMLParser
+from Queue import Full
 
-def match_phone_numbers(content):
+class ExcludeMatcher(object):
     """
-    Given a string input, find all phone numbers in that
-    string.
+    The Exclude Matcher.
 
-    Input:
-    content - string - the content to look through
+    Compiles the 'excludes' into an Aho-Corasick automaton,
+    so checking whether any exclusion is found in a string
+    costs the same however many exclusions there are.
+    """
+
+    def __init__(self, excludes):
+        """
+        ExcludeMatcher constructor.
+
+        Args:
+            excludes: list - the strings to look for
+        """
+        # each state has its transitions, and whether an
+        # exclusion ends at the state
+        self._transitions = [{}]
+        self._terminal = [False]
+
+        for exclusion in excludes:
+            self._add(exclusion)
+
+        self._failures = self._link()
+
+    def _add(self, exclusion):
+        """
+        Add an exclusion to the automaton's trie.
+        """
+        state = 0
+
+        for char in exclusion:
+            if char not in self._transitions[state]:
+                self._transitions.append({})
+                self._terminal.append(False)
+                self._transitions[state][char] = len(self._transitions) - 1
+
+            state = self._transitions[state][char]
+
+        self._terminal[state] = True
+
+    def _link(self):
+        """
+        Link each state to the state of its longest proper
+        suffix, in breadth first order.
+
+        Returns:
+            list - the failure state of each state
+        """
+        failures = [0] * len(self._transitions)
+        queue = list(self._transitions[0].values())
+
+        for state in queue:
+            for char, child in self._transitions[state].items():
+                failure = failures[state]
+
+                while failure and char not in self._transitions[failure]:
+                    failure = failures[failure]
+
+                failure = self._transitions[failure].get(char, 0)
+
+                failures[child] = failure
+                self._terminal[child] = self._terminal[child] \
+                                            or self._terminal[failure]
+                queue.append(child)
+
+        return failures
+
+    def found_in(self, content):
+        """
+        Check whether any exclusion is found in some content.
+
+        Input:
+        content - string - the content to look through
+
+        Returns:
+        bool - True if an exclusion is a substring of the content
+        """
+        if self._terminal[0]:
+            return True
+
+        transitions = self._transitions
+        failures = self._failures
+        terminal = self._terminal
+        state = 0
+
+        for char in content:
+            while state and char not in transitions[state]:
+                state = failures[state]
+
+            state = transitions[state].get(char, 0)
+
+            if terminal[state]:
+                return True
+
+        return False
+
+# block level end tags followed by another tag, where html
+# content can be split into blocks to redact on their own
+BLOCK_END = re.compile(
+    r"</(?:p|div|tr|table|tbody|blockquote|li|ul|ol|h[1-6])>(?=<)", re.I)
+
+# joins the contents scanned together in a batch, no built in
+# detector can match it, and it is a word boundary either side
+BATCH_SEPARATOR = '\n\0\n'
+
+# pattern syntax that looks at the start or end of the content,
+# or past a match, so can't be scanned in a batch
+POSITIONAL = ('^', '$', '\\A', '\\Z', '(?=', '(?!', '(?<')
+
+class RedactionEngine(object):
+    """
+    The Redaction Engine.
+
+    Compiles a set of detectors into a single alternation
+    and redacts content in one left to right pass.
+    """
+
+    def __init__(self, detectors, redaction_string, excludes=None):
+        """
+        RedactionEngine constructor.
+
+        Args:
+            detectors: list - the Detectors to run, earlier
+                detectors win when matches start at the same
+                position
+            redaction_string: the string to replace matches with
+            excludes: list - strings which, when found in a match
+                of an excludable detector, exclude it from redaction
+        """
+        self._detectors = tuple(detectors)
+        self._redaction_string = redaction_string
+        self._excludes = ExcludeMatcher(excludes or [])
+        self._excludable = set(detector.name
+                                for detector in self._detectors
+                                    if detector.excludable)
+        self._inner = tuple(detector for detector in self._detectors
+                                if not detector.excludable)
+        self._splittable = not any(detector.crosses_tags
+                                    for detector in self._detectors)
+        self._batchable = not any(syntax in detector.pattern
+                                    for detector in self._detectors
+                                        for syntax in POSITIONAL)
+        self._patterns = {}
+        self._pattern(self._detectors)
+
+    def _pattern(self, detectors):
+        """
+        Get the alternation of some of the engine's detectors,
+        compiling it on first use.
+        """
+        names = tuple(detector.name for detector in detectors)
+
+        if names not in self._patterns:
+            self._patterns[names] = re.compile('|'.join(
+                '(?P<{}>{})'.format(detector.name, detector.pattern)
+                    for detector in detectors))
+
+        return self._patterns[names]
+
+    def excluded(self, name, match):
+        """
+        Check whether a match is excluded from redaction.
+
+        Only matches of excludable detectors, like email
+        addresses, can be excluded, using the configured
+        'excludes'.
+
+        Returns:
+            bool - True if the match should be left as is
+        """
+        if name not in self._excludable:
+            return False
+
+        return self._excludes.found_in(match)
+
+    def _finditer(self, content):
+        """
+        Find all matches in some given content, including
+        the excluded ones.
+
+        Detectors whose prefilter rules out the content are
+        left out of the alternation.
+        """
+        if not isinstance(content, basestring):
+            raise ValueError('content must be a string.')
+
+        active = []
+
+        for detector in self._detectors:
+            if detector.applies(content):
+                active.append(detector)
+            else:
+                metrics.incr('redact_prefilter_skips_total',
+                                detector=detector.name)
+
+        if not active:
+            return iter(())
+
+        return self._pattern(active).finditer(content)
+
+    def _inner_finditer(self, content, start, end):
+        """
+        Find the matches of the detectors that can't be
+        excluded within a match of one that can, which its
+        match took the place of in the alternation.
+        """
+        active = [detector for detector in self._inner
+                    if detector.applies(content[start:end])]
+
+        if not active:
+            return iter(())
+
+        return self._pattern(active).finditer(content, start, end)
+
+    def _apply(self, content, matches, counts):
+        """
+        Redact matches from some given content, redacting the
+        matches found within the excluded ones instead.
+
+        The output is built from slices of the content
+        and joined once.
+
+        Input:
+        content - string - the content to redact
+        matches - iterable - the (detector name, start, end) of
+            each match of the alternation, from left to right
+        counts - dict - the number of redactions per detector,
+            updated with the content's
+
+        Returns:
+        tuple - the redacted content, and a list of the
+            (detector name, start, end) of each match, with the
+            matches within excludable ones after them
+        """
+        pieces = []
+        found = []
+        position = 0
+
+        for name, start, end in matches:
+            found.append((name, start, end))
+            inner = []
+
+            # matches within an excludable one are noted whether
+            # it's excluded or not, so spans can be applied again
+            # with other excludes
+            if name in self._excludable:
+                inner = [(match.lastgroup, match.start(), match.end())
+                            for match in self._inner_finditer(
+                                content, start, end)]
+                found.extend(inner)
+
+            if not self.excluded(name, content[start:end]):
+                inner = [(name, start, end)]
+
+            for detector, match_start, match_end in inner:
+                pieces.append(content[position:match_start])
+                pieces.append(self._redaction_string)
+                position = match_end
+                counts[detector] = counts.get(detector, 0) + 1
+
+        if not pieces:
+            return content, found
+
+        pieces.append(content[position:])
+        return ''.join(pieces), found
+
+    def matches(self, content):
+        """
+        Find all redactable matches in some given content.
+
+        Input:
+        content - string - the content to look through
+
+        Returns:
+        generator - (detector name, match object) tuples, from
+            left to right
+        """
+        for match in self._finditer(content):
+            if not self.excluded(match.lastgroup, match.group()):
+                yield match.lastgroup, match
+                continue
+
+            for inner in self._inner_finditer(
+                                content, match.start(), match.end()):
+                yield inner.lastgroup, inner
+
+    def scan(self, content):
+        """
+        Redact all matches from some given content, and note
+        where every match was found, excluded or not.
+
+        The output is built from slices of the content
+        and joined once.
+
+        Input:
+        content - string - the content to redact
+
+        Returns:
+        tuple - the redacted content, and a list of the
+            (detector name, start, end) of each match
+        """
+        matches = [(match.lastgroup, match.start(), match.end())
+                        for match in self._finditer(content)]
+        counts = {}
+        redacted, found = self._apply(content, matches, counts)
+
+        # count matches once per detector, not once per match
+        for name, count in counts.items():
+            metrics.incr('redact_matches_total', count, detector=name)
+
+        return redacted, found
+
+    def redact(self, content):
+        """
+        Redact all matches from some given content.
+
+        Input:
+        content - string - the content to redact
+
+        Returns:
+        string - the redacted content
+        """
+        return self.scan(content)[0]
+
+    def scan_many(self, contents):
+        """
+        Scan a batch of contents in one pass, joined by the
+        BATCH_SEPARATOR, and split the matches back up.
+
+        Contents with a match running into the separator are
+        scanned again on their own, as are all the contents
+        when a detector looks at the start or end of content.
+
+        Input:
+        contents - list - the strings to redact
+
+        Returns:
+        list - the scan of each content, see scan
+        """
+        if not self._batchable or len(contents) < 2 \
+                or len(set(type(content) for content in contents)) > 1 \
+                or not isinstance(contents[0], basestring):
+            return [self.scan(content) for content in contents]
+
+        starts = []
+        position = 0
+
+        for content in contents:
+            starts.append(position)
+            position += len(content) + len(BATCH_SEPARATOR)
+
+        buffer = BATCH_SEPARATOR.join(contents)
+        found = [[] for content in contents]
+        rescan = set()
+
+        for match in self._finditer(buffer):
+            index = bisect_right(starts, match.start()) - 1
+            start = match.start() - starts[index]
+            end = match.end() - starts[index]
+
+            if end > len(contents[index]):
+                last = bisect_right(starts, match.end() - 1) - 1
+                rescan.update(range(index, last + 1))
+                continue
+
+            found[index].append((match.lastgroup, start, end))
+
+        scans = []
+        counts = {}
+
+        for index, content in enumerate(contents):
+            if index in rescan:
+                scans.append(self.scan(content))
+                continue
+
+            scans.append(self._apply(content, found[index], counts))
+
+        for name, count in counts.items():
+            metrics.incr('redact_matches_total', count, detector=name)
+
+        return scans
+
+    def scan_blocks(self, content, memo):
+        """
+        Scan html content one block at a time, reusing the
+        scans of blocks seen before.
+
+        No match can span a block boundary or look across it
+        unless a detector crosses tags, so the output is the
+        same as scanning the content in one go. When one
+        does, the content is scanned in one go instead.
+
+        Input:
+        content - string - the content to redact
+        memo - dict - scanned blocks keyed by the original
+            blocks, updated with the content's new blocks
+
+        Returns:
+        tuple - the redacted content, and a list of the
+            (detector name, start, end) of each match
+        """
+        if not self._splittable or not isinstance(content, basestring):
+            return self.scan(content)
+
+        blocks = []
+        position = 0
+
+        for end in BLOCK_END.finditer(content):
+            blocks.append(content[position:end.end()])
+            position = end.end()
+
+        blocks.append(content[position:])
+
+        pieces = []
+        found = []
+        position = 0
+        reused = 0
+
+        for block in blocks:
+            scan = memo.get(block)
+
+            if scan is None:
+                scan = self.scan(block)
+                memo[block] = scan
+            else:
+                reused += 1
+
+            redacted, block_found = scan
+            pieces.append(redacted)
+            found.extend((name, position + start, position + end)
+                            for name, start, end in block_found)
+            position += len(block)
+
+        metrics.incr('redact_blocks_total', len(blocks))
+        metrics.incr('redact_blocks_reused_total', reused)
+
+        return ''.join(pieces), found
+
+    def redact_blocks(self, content, memo):
+        """
+        Redact html content one block at a time, reusing the
+        redacted form of blocks seen before.
+
+        Input:
+        content - string - the content to redact
+        memo - dict - scanned blocks keyed by the original
+            blocks, updated with the content's new blocks
+
+        Returns:
+        string - the redacted content
+        """
+        return self.scan_blocks(content, memo)[0]
+
+# compiled engines, keyed by their detector names
+_engines = {}
+
+# the detector names of each email field
+_fields = {}
+
+# compiled detector patterns
+_patterns = {}
+
+def redaction_engine(names):
+    """
+    Get a compiled redaction engine for the named detectors.
+
+    Engines are compiled once, using the configured 'excludes'
+    and 'redaction_string'.
+
+    Args:
+        names: tuple - the names of the detectors to use
 
     Returns:
-    list - a list of matches
+        RedactionEngine - the engine
+    """
+    if names not in _engines:
+        _engines[names] = RedactionEngine(
+            detectors.named(names),
+            config.redaction_string,
+            config.excludes)
+
+    return _engines[names]
+
+def field_engine(field):
+    """
+    Get the redaction engine for a field of an email.
+    """
+    if field not in _fields:
+        _fields[field] = tuple(
+            detector.name for detector in detectors.for_field(field))
+
+    return redaction_engine(_fields[field])
+
+def _compiled(pattern):
+    """
+    Get a compiled pattern, compiling it on first use.
+    """
+    if pattern not in _patterns:
+        _patterns[pattern] = re.compile(pattern)
+
+    return _patterns[pattern]
+
+def _findall(patterns, content):
+    """
+    Find all matches for a list of patterns in some
+    given content.
     """
     if not isinstance(content, basestring):
         raise ValueError('content must be a string.')
 
-    patterns = [
-        "\\(?\\d{3}\\)?[.-]? *\\d{3}[.-]? *[.-]?\\d{4}",
-        "\\(\\d{3}\\)\\s\\d{3}-\\d{4}",
-        "\(\d{2,4}\)\d{6,7}",
-        "\(\d{2,4}\) \d{6,7}",
-        r"(^[0][2][1579]{1})(\d{6,7}$)"
-    ]
-
     matches = []
 
     for pattern in patterns:
-        matches.extend(re.findall(pattern, content))
+        matches.extend(_compiled(pattern).findall(content))
 
     return matches
 
+def match_phone_numbers(content):
+    """
+    Given a string input, find all phone numbers in that
+    string.
+
+    Input:
+    content - string - the content to look through
+
+    Returns:
+    list - a list of matches
+    """
+    return _findall(detectors.PHONE_NUMBER_PATTERNS, content)
+
 def redact_phone_numbers(content):
     """
     Redact any phone numbers from some given content.
     """
-    for number in match_phone_numbers(content):
-        content = content.replace(number, config.redaction_string)
-
-    return content
+    return redaction_engine(('phone_number',)).redact(content)
 
 def match_email_address(content):
     """
@@ -61,11 +577,7 @@ def match_email_address(content):
     Returns:
     list - a list of matches
     """
-    if not isinstance(content, basestring):
-        raise ValueError('content must be a string.')
-
-    pattern = r'[\w\.-]+@[\w\.-]+\.\w+'
-    return re.findall(pattern, content)
+    return _findall(detectors.EMAIL_ADDRESS_PATTERNS, content)
 
 def redact_email_address(content):
     """
@@ -74,20 +586,7 @@ def redact_email_address(content):
     This method makes use of the configuration 'excludes' to 
     exclude the redaction of some email addresses.
     """
-    def replace(match, content):
-        """
-        Exclude the replacement of any 'excludes'.
-        """
-        for exclusion in config.excludes:
-            if exclusion in match:
-                return content
-
-        return content.replace(match, config.redaction_string)
-
-    for match in match_email_address(content):
-        content = replace(match, content)
-
-    return content
+    return redaction_engine(('email_address',)).redact(content)
 
 def match_ip_address(content):
     """
@@ -99,29 +598,19 @@ def match_ip_address(content):
     Returns:
     list - a list of matches
     """
-    if not isinstance(content, basestring):
-        raise ValueError('content must be a string.')
-
-    patterns = [
-        "\b((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(\.|$)){4}\b",
-        r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b"
-    ]
-
-    matches = []
-
-    for pattern in patterns:
-        matches.extend(re.findall(pattern, content))
-
-    return matches
+    return _findall(detectors.IP_ADDRESS_PATTERNS, content)
 
 def redact_ip_address(content):
     """
     Redact any ip addresses from some given content.
     """
-    for match in match_ip_address(content):
-        content = content.replace(match, config.redaction_string)
+    return redaction_engine(('ip_address',)).redact(content)
 
-    return content
+class Redaction(unicode):
+    """
+    A redaction string added to html data by the parser,
+    told apart from the data around it.
+    """
 
 class EmailHtmlParser(HTMLParser):
     """
@@ -129,16 +618,24 @@ class EmailHtmlParser(HTMLParser):
 
     This parses html content from emails containing
     delivery addresses and other sensitive information.
+
+    A parser can be reused for any number of emails, it
+    is reset before each one is parsed.
     """
 
     def __init__(self):
         """
         EmailHtmlParser constructor.
         """
-        self.redacting = False
         self.reset()
-        self.newtags = []
-        self.newattrs = []
+
+    def reset(self):
+        """
+        Reset the parser, discarding any html data.
+        """
+        HTMLParser.reset(self)
+        self.redacting = False
+        self.redaction_string = config.redaction_string
         self.htmldata = []
         self.trs = []
 
@@ -146,17 +643,15 @@ class EmailHtmlParser(HTMLParser):
         """
         Handler to run when a start tag is encountered.
 
-        Takes note of how many trs, tags and attrs are 
-        encountered, to ensure it can correctly deconstruct
-        the html.
+        Takes note of where trs start in the html data, to
+        ensure it can correctly deconstruct the html.
         """
-        self.newtags.append(tag)
-        self.newattrs.append(attrs)
+        for item in attrs:
+            if 'href' in item:
+                if '?member=' in item[1]:
+                    self.redacting = True
 
-        hrefs = [item for item in attrs if 'href' in item]
-
-        if hrefs and '?member=' in hrefs[0][1]:
-            self.redacting = True
+                break
 
         if 'tr' in tag:
             self.trs.append(len(self.htmldata))
@@ -172,26 +667,27 @@ class EmailHtmlParser(HTMLParser):
         """
         Handler to run when an end tag is encountered.
 
-        Takes not of how many trs, tags and attrs
-        are encountered, to ensure it can correctly construct
-        the html again.
+        Takes note of where trs end in the html data, and
+        drops rows containing a delivery address in place,
+        keeping only what follows the row.
         """
+        htmldata = self.htmldata
+
         if 'tr' in tag:
-            self.trs.append(len(self.htmldata))
+            self.trs.append(len(htmldata))
 
         if self.redacting:
             self.redacting = False
 
         if tag is not 'html':
-            self.htmldata.append('</' + tag + '>')
+            htmldata.append('</' + tag + '>')
 
         if len(self.trs) == 2:
-            check = ''.join(self.htmldata[self.trs[0]:self.trs[1]])
-            if 'Delivery address' in check:
-                one = self.htmldata[0:self.trs[0]-1]
-                two = self.htmldata[self.trs[1]:]
-                final = one + two
-                self.htmldata = final
+            start, end = self.trs
+
+            if 'Delivery address' in ''.join(htmldata[start:end]):
+                htmldata[start - 1:] = htmldata[end:]
+
             self.trs = []
 
     def handle_data(self, data):
@@ -199,17 +695,15 @@ class EmailHtmlParser(HTMLParser):
         Add the redaction string to the html data.
         """
         if self.redacting:
-            self.htmldata.append(config.redaction_string)
+            self.htmldata.append(Redaction(self.redaction_string))
             return
 
         self.htmldata.append(data)
 
     def clean(self):
         """
-        Empty out the html tag counters.
+        Empty out the html data.
         """
-        self.newtags = []
-        self.newattrs = []
         self.htmldata = []
 
     def parsed_data(self):
@@ -221,89 +715,884 @@ class EmailHtmlParser(HTMLParser):
         """
         return ''.join(self.htmldata)
 
-def redact_email(email):
+    def redactions(self):
+        """
+        Get where the parser added the redaction string to
+        the parsed data.
+
+        Returns:
+        list - the (start, end) of each redaction
+        """
+        found = []
+        position = 0
+
+        for item in self.htmldata:
+            if isinstance(item, Redaction):
+                found.append((position, position + len(item)))
+
+            position += len(item)
+
+        return found
+
+    def parse(self, body, redaction_string=None):
+        """
+        Parse an email body, redacting its html.
+
+        Input:
+        body - string - the email body
+        redaction_string - string - the string to redact with,
+            defaults to the configured 'redaction_string'
+
+        Returns:
+        string - the redacted html string.
+        """
+        self.reset()
+
+        if redaction_string is not None:
+            self.redaction_string = redaction_string
+
+        self.feed(body)
+        return self.parsed_data()
+
+# the html parser of each thread
+_parsers = threading.local()
+
+def html_parser():
     """
-    Given an Email, redact the Email of redactable contents and
-    generate a RedactedEmail.
+    Get the html parser of the current thread.
+
+    Returns:
+    EmailHtmlParser - a parser to reuse across emails
+    """
+    parser = getattr(_parsers, 'parser', None)
+
+    if parser is None:
+        parser = _parsers.parser = EmailHtmlParser()
+
+    return parser
+
+# the redaction cache of the current process, keyed by pid
+_caches = {}
+
+def redaction_cache():
+    """
+    Get the redaction cache of the current process, built on
+    first use from the configured 'redaction_cache_size' and
+    'redaction_cache_file'.
+
+    Returns:
+    RedactionCache - the cache, or None if caching is off
+    """
+    pid = os.getpid()
+
+    if pid not in _caches:
+        size = getattr(config, 'redaction_cache_size', 0)
+        path = getattr(config, 'redaction_cache_file', None)
+        _caches.clear()
+        _caches[pid] = None
+
+        if size or path:
+            _caches[pid] = cache.RedactionCache(
+                cache.fingerprint(config.redaction_string,
+                                    config.excludes,
+                                    detectors.registry()),
+                size,
+                path)
+
+    return _caches[pid]
+
+def flush_cache():
+    """
+    Write any pending redaction cache entries to disk.
+    """
+    redactions = _caches.get(os.getpid())
+
+    if redactions is not None:
+        redactions.flush()
+
+class BlockMemo(LRUCache):
+    """
+    The Block Memo.
+
+    Remembers the scans of html blocks, least recently used
+    first out, bounded by the characters of redacted content
+    it holds. Blocks too large to fit aren't remembered.
+    """
+
+    def __init__(self, size):
+        """
+        BlockMemo constructor.
+
+        Args:
+            size: the number of characters of redacted blocks
+                to remember
+        """
+        LRUCache.__init__(self, size, getsizeof=lambda scan: len(scan[0]))
+
+    def __setitem__(self, block, scan):
+        if self.getsizeof(scan) <= self.maxsize:
+            LRUCache.__setitem__(self, block, scan)
+
+# the scanned blocks of recent email threads
+_threads = {}
+
+def thread_memo(thread_id):
+    """
+    Get the scanned html blocks of the emails redacted
+    before, to reuse in an email of a thread, remembering
+    the configured 'thread_delta_size' characters of them.
+
+    A block's scan only depends on its content, so the
+    blocks are shared by every thread.
+
+    Returns:
+    BlockMemo - scanned blocks keyed by the original blocks,
+        or None if thread delta redaction is off
+    """
+    size = getattr(config, 'thread_delta_size', 0)
+
+    if not thread_id or not size:
+        return None
+
+    if 'memo' not in _threads:
+        _threads['memo'] = BlockMemo(size)
+
+    return _threads['memo']
+
+def whole_field(field, redacted):
+    """
+    Redact the whole of an address field once any of it
+    has been redacted.
 
     Input:
-    email - Email - the email to be redacted.
+    field - string - the name of the field
+    redacted - string - the redacted content of the field
 
     Returns:
-    RedactedEmail - the redacted email instance.
+    string - the redacted content
+    """
+    # we want the "from" and "to" fields to be fully redacted
+    # if the email address has been redacted
+    if field in ('email_from', 'email_to') \
+            and config.redaction_string in redacted:
+        return config.redaction_string
+
+    return redacted
+
+def scan_field(field, content, thread_id=None):
+    """
+    Redact the redactable contents of one field of an email,
+    noting where each match was found.
+
+    Bodies of emails in the same thread usually quote the
+    earlier emails, so the blocks of a body already scanned
+    for an earlier email in the thread are reused.
+
+    Input:
+    field - string - the name of the field
+    content - string - the content of the field
+    thread_id - string - the id of the email's thread, if any
+
+    Returns:
+    tuple - the redacted content, the content the detectors
+        ran over and a list of the (detector name, start, end)
+        of each match in it, redactions by the html parser
+        included
+    """
+    memo = None
+    found = []
+
+    if field == 'body':
+        # we need to parse the html content for the body as well
+        with metrics.timer('redact_html_parse_seconds'):
+            parser = html_parser()
+            content = parser.parse(content)
+
+        found = [(spans.HTML, start, end)
+                    for start, end in parser.redactions()]
+        memo = thread_memo(thread_id)
+
+    with metrics.timer('redact_regex_seconds', field=field):
+        if memo is None:
+            redacted, matched = field_engine(field).scan(content)
+        else:
+            redacted, matched = field_engine(field).scan_blocks(
+                                    content, memo)
+
+    redacted = whole_field(field, redacted)
+
+    return redacted, content, sorted(found + matched, key=lambda s: s[1])
+
+def redact_field(field, content, thread_id=None):
     """
-    subject = email.subject
-    email_from = email.email_from
-    email_to = email.email_to
-    body = email.body
+    Redact the redactable contents of one field of an email.
 
-    redacted_subject = redact_email_address(subject)
-    redacted_subject = redact_ip_address(redacted_subject)
-    # it is unlikely that subjets will have phone numbers
-    # so we are not redacting phone numbers from the subject
+    Input:
+    field - string - the name of the field
+    content - string - the content of the field
+    thread_id - string - the id of the email's thread, if any
+
+    Returns:
+    string - the redacted content
+    """
+    return scan_field(field, content, thread_id)[0]
+
+def cached_field(field, content, thread_id=None):
+    """
+    Redact one field of an email, using the redaction cache
+    when it is on.
+    """
+    redactions = redaction_cache()
+
+    if redactions is None:
+        return redact_field(field, content, thread_id)
+
+    return redactions.redacted(
+        field, content,
+        lambda content: redact_field(field, content, thread_id))
+
+def cached_entities(field, content, thread_id=None):
+    """
+    Redact one field of an email and describe its matches,
+    using the redaction cache when it is on.
+
+    Returns:
+    tuple - the redacted content, and the entities found in
+        the field, see spans.entities
+    """
+    def scan(content):
+        redacted, scanned, found = scan_field(field, content, thread_id)
+        return redacted, spans.entities(field, scanned, found)
+
+    redactions = redaction_cache()
 
-    redacted_email_from = redact_email_address(email_from)
+    if redactions is None or not isinstance(content, basestring):
+        return scan(content)
 
-    # we want the "from" field to be fully redacted if the
-    # email address has been redacted
-    if config.redaction_string in redacted_email_from:
-        redacted_email_from = config.redaction_string
+    # cached under a field name of their own, as json
+    redacted, entities = json.loads(redactions.redacted(
+        field + '.spans', content,
+        lambda content: json.dumps(scan(content))))
+
+    return redacted, entities
+
+def scan_fields(subject, email_from, email_to, body, thread_id=None):
+    """
+    Redact the redactable contents of the fields of an email,
+    describing the matches found in them.
+
+    Input:
+    subject - string - the email subject
+    email_from - string - the email "from" field
+    email_to - string - the email "to" field
+    body - string - the email body
+    thread_id - string - the id of the email's thread, if any
+
+    Returns:
+    tuple - the redacted (subject, email_from, email_to, body),
+        and the entities found in them, see spans.entities
+    """
+    redacted = []
+    entities = []
+
+    for field, content in (('subject', subject),
+                            ('email_from', email_from),
+                            ('email_to', email_to),
+                            ('body', body)):
+        field_redacted, field_entities = cached_entities(
+            field, content, thread_id if field == 'body' else None)
+        redacted.append(field_redacted)
+        entities.extend(field_entities)
+
+    metrics.incr('redact_emails_total')
+    return tuple(redacted), entities
+
+def scan_headers(field, contents, with_spans=False):
+    """
+    Redact one header field of a batch of emails, scanning
+    the contents missing from the redaction cache together.
+
+    Input:
+    field - string - the name of the field
+    contents - list - the content of the field of each email
+    with_spans - bool - whether to describe the matches too
+
+    Returns:
+    list - the redacted content of each email, and the
+        entities found in it or None without spans
+    """
+    redactions = redaction_cache()
+    key = field + '.spans' if with_spans else field
+    results = [None] * len(contents)
+    misses = []
 
-    redacted_email_to = redact_email_address(email_to)
+    for index, content in enumerate(contents):
+        if redactions is not None and isinstance(content, basestring):
+            value = redactions.get(key, content)
 
-    # we want the "to" field to be fully redacted if the
-    # email address has been redacted
-    if config.redaction_string in redacted_email_to:
-        redacted_email_to = config.redaction_string
+            if value is not None:
+                results[index] = json.loads(value) if with_spans \
+                                    else (value, None)
+                continue
 
-    # we need to parse the html content for the body as well
-    parser = EmailHtmlParser()
-    parser.feed(body)
+        misses.append(index)
 
-    redacted_body = parser.parsed_data()
-    redacted_body = redact_email_address(redacted_body)
-    redacted_body = redact_ip_address(redacted_body)
-    redacted_body = redact_phone_numbers(redacted_body)
+    with metrics.timer('redact_regex_seconds', field=field):
+        scans = field_engine(field).scan_many(
+                    [contents[index] for index in misses])
+
+    for index, (redacted, found) in zip(misses, scans):
+        content = contents[index]
+        redacted = whole_field(field, redacted)
+        entities = None
+
+        if with_spans:
+            entities = spans.entities(field, content, found)
+
+        if redactions is not None and isinstance(content, basestring):
+            redactions.put(key, content, json.dumps([redacted, entities])
+                                            if with_spans else redacted)
+
+        results[index] = (redacted, entities)
+
+    return results
+
+def redact_many(records):
+    """
+    Redact a batch of email records.
+
+    The subjects, froms and tos of the batch are each scanned
+    in one pass, instead of once per email, bodies are still
+    redacted one at a time.
+
+    Input:
+    records - list - dicts of the Email column values
+
+    Returns:
+    list - the RedactedEmail column values of each record,
+        the same as redact_record would give
+    """
+    with_spans = spans.enabled()
+    headers = [scan_headers(field, [record[field] for record in records],
+                            with_spans)
+                for field in ('subject', 'email_from', 'email_to')]
+    rows = []
+
+    for index, record in enumerate(records):
+        thread_id = record.get('thread_id')
+
+        if with_spans:
+            body, body_entities = cached_entities(
+                                    'body', record['body'], thread_id)
+        else:
+            body = cached_field('body', record['body'], thread_id)
+
+        subject, email_from, email_to = [results[index][0]
+                                            for results in headers]
+        row = {
+            'id': record['id'],
+            'thread_id': record['thread_id'],
+            'external_id': record['external_id'],
+            'time': record['time'],
+            'subject': subject,
+            'email_from': email_from,
+            'email_to': email_to,
+            'body': body,
+        }
+
+        if with_spans:
+            row['_spans'] = [entity for results in headers
+                                for entity in results[index][1]] \
+                                    + body_entities
+
+        rows.append(row)
+
+    metrics.incr('redact_emails_total', len(records))
+    return rows
+
+def redact_fields(subject, email_from, email_to, body, thread_id=None):
+    """
+    Redact the redactable contents of the fields of an email.
+
+    This is a pure function of its inputs and the config, so it
+    can be run in worker processes.
+
+    Input:
+    subject - string - the email subject
+    email_from - string - the email "from" field
+    email_to - string - the email "to" field
+    body - string - the email body
+    thread_id - string - the id of the email's thread, if any
+
+    Returns:
+    tuple - the redacted (subject, email_from, email_to, body)
+    """
+    redacted = (
+        cached_field('subject', subject),
+        cached_field('email_from', email_from),
+        cached_field('email_to', email_to),
+        cached_field('body', body, thread_id),
+    )
+
+    metrics.incr('redact_emails_total')
+    return redacted
+
+def redact_email(email):
+    """
+    Given an Email, redact the Email of redactable contents and
+    generate a RedactedEmail.
+
+    Input:
+    email - Email - the email to be redacted.
+
+    Returns:
+    RedactedEmail - the redacted email instance.
+    """
+    subject, email_from, email_to, body = redact_fields(
+        email.subject, email.email_from, email.email_to, email.body,
+        email.thread_id)
 
     return models.RedactedEmail(
                 id=email.id,
                 thread_id=email.thread_id,
                 external_id=email.external_id,
-                subject=redacted_subject,
-                email_from=redacted_email_from,
-                email_to=redacted_email_to,
+                subject=subject,
+                email_from=email_from,
+                email_to=email_to,
                 time=email.time,
-                body=redacted_body)
+                body=body)
+
+# the email columns streamed to redaction workers
+ROW_COLUMNS = (
+    models.Email.id,
+    models.Email.thread_id,
+    models.Email.external_id,
+    models.Email.time,
+    models.Email.subject,
+    models.Email.email_from,
+    models.Email.email_to,
+    models.Email.body,
+)
+
+# the names of the streamed email columns
+ROW_NAMES = tuple(column.key for column in ROW_COLUMNS)
+
+def pending_query(session, columns):
+    """
+    Query the emails that have not been redacted yet.
 
-def run():
+    Args:
+        session: the db session to query with
+        columns: tuple - the entities or columns to load
+
+    Returns:
+        Query - the emails
     """
-    Run redaction.
+    # only redact emails not already redacted, both ids are
+    # primary keys so each email is checked with an index lookup
+    return session.query(*columns) \
+                .outerjoin(models.RedactedEmail,
+                            models.RedactedEmail.id == models.Email.id) \
+                .filter(models.RedactedEmail.id == None)
+
+def pending_rows(page_size=None):
     """
-    session = models.db_session()
+    Stream the emails that have not been redacted yet as
+    plain tuples, in id order.
 
-    try:
-        # only redact emails not already redacted
-        ids = session.query(models.RedactedEmail.id).distinct()
-        base_id = 0
+    Args:
+        page_size: the number of emails read per query, defaults
+            to the configured 'stream_page_size'
 
-        while True:
-            emails = session.query(models.Email) \
-                        .filter(~models.Email.id.in_(ids)) \
-                        .order_by(models.Email.id.asc()) \
-                        .filter(models.Email.id>base_id) \
-                        .limit(100) \
-                        .all()
-
-            if not len(emails):
-                break
+    Yields:
+        tuple - the values of ROW_COLUMNS for an email
+    """
+    return models.stream(
+        lambda session: pending_query(session, ROW_COLUMNS),
+        models.Email.id,
+        page_size)
+
+def redact_record(record):
+    """
+    Redact an email record.
+
+    Input:
+    record - dict - the Email column values
+
+    Returns:
+    dict - the RedactedEmail column values, with the entities
+        found under '_spans' when the span index is on
+    """
+    fields = (record['subject'], record['email_from'],
+                record['email_to'], record['body'], record.get('thread_id'))
+    entities = None
+
+    if spans.enabled():
+        redacted, entities = scan_fields(*fields)
+    else:
+        redacted = redact_fields(*fields)
+
+    subject, email_from, email_to, body = redacted
+    row = {
+        'id': record['id'],
+        'thread_id': record['thread_id'],
+        'external_id': record['external_id'],
+        'time': record['time'],
+        'subject': subject,
+        'email_from': email_from,
+        'email_to': email_to,
+        'body': body,
+    }
+
+    if entities is not None:
+        row['_spans'] = entities
+
+    return row
+
+def redact_rows(rows):
+    """
+    Redact a batch of email rows streamed by pending_rows.
+
+    Returns:
+        list - the RedactedEmail column values of each row
+    """
+    return redact_many([dict(zip(ROW_NAMES, row)) for row in rows])
+
+def redact_batch(rows):
+    """
+    Redact a batch of email rows in a worker process, and
+    write its pending redaction cache entries, which would
+    otherwise be lost when the pool stops the worker.
+
+    Returns:
+        list - the RedactedEmail column values of each row
+    """
+    redacted = redact_rows(rows)
+    flush_cache()
+    return redacted
+
+def batches(rows, batch_size=None):
+    """
+    Group streamed rows into batches.
+
+    Args:
+        rows: iterable - the rows
+        batch_size: the number of rows per batch, defaults to
+            the configured 'redact_batch_size'
+
+    Yields:
+        list - the rows of each batch
+    """
+    rows = iter(rows)
+    batch_size = batch_size or getattr(config, 'redact_batch_size', 100)
+
+    while True:
+        batch = list(islice(rows, batch_size))
+
+        if not batch:
+            return
+
+        yield batch
+
+def index_rows(session, rows):
+    """
+    Index a chunk of redacted rows for search, record their
+    entity spans and invalidate any files transformed from
+    earlier rows of the same ids, in the same transaction as
+    the rows.
+
+    Args:
+        session: the db session to write with
+        rows: list - dicts of the RedactedEmail column values
+    """
+    search.index(session, rows)
+    spans.index(session, rows)
+    transform.invalidate(session, models.RedactedEmail.__tablename__,
+                            [row['id'] for row in rows])
+
+def rewrite_field(field, content, entities, scan_string):
+    """
+    Redact one field of an email again from its entity
+    spans, with the configured 'excludes' and
+    'redaction_string', without running the detectors.
+
+    Input:
+    field - string - the name of the field
+    content - string - the content of the field
+    entities - list - the (detector, start, end, value hash)
+        of each span in the field, in offset order
+    scan_string - string - the redaction string the spans
+        were recorded with
+
+    Returns:
+    string - the redacted content
+    """
+    if field == 'body':
+        # parse with the string the spans were recorded with, so
+        # the offsets are the same, its redactions are spans too
+        content = html_parser().parse(content, scan_string)
+
+    engine = field_engine(field)
+    pieces = []
+    position = 0
+
+    # a match comes before the matches within it
+    entities = sorted(entities, key=lambda entity: (entity[1], -entity[2]))
+
+    for name, start, end, digest in entities:
+        value = content[start:end]
+
+        if spans.value_hash(value) != digest:
+            raise spans.StaleSpans(
+                'The {} span at {} of {} has changed.'.format(
+                    name, start, field))
+
+        if start < position or engine.excluded(name, value):
+            continue
+
+        pieces.append(content[position:start])
+        pieces.append(config.redaction_string)
+        position = end
+
+    pieces.append(content[position:])
+    redacted = ''.join(pieces)
+
+    redacted = whole_field(field, redacted)
 
-            # go through each email and redact it
-            for email in emails:
-                session.add(redact_email(email))
+    return redacted
 
-            base_id = emails[-1].id
+def rewrite_record(record, entities, scan_string):
+    """
+    Redact an email record again from its entity spans.
+
+    Input:
+    record - dict - the Email column values
+    entities - list - the (field, detector, start, end,
+        value hash) of each span of the email
+    scan_string - string - the redaction string the spans
+        were recorded with
+
+    Returns:
+    dict - the RedactedEmail column values
+    """
+    fields = dict((field, []) for field in detectors.FIELDS)
+
+    for entity in entities:
+        fields[entity[0]].append(entity[1:])
+
+    row = {
+        'id': record['id'],
+        'thread_id': record['thread_id'],
+        'external_id': record['external_id'],
+        'time': record['time'],
+    }
+
+    for field in detectors.FIELDS:
+        row[field] = rewrite_field(
+            field, record[field], fields[field], scan_string)
+
+    return row
+
+def reapply(session=None, batch_size=500):
+    """
+    Apply the configured 'excludes' and 'redaction_string' to
+    the redacted emails recorded in the span index, rewriting
+    only the emails they change.
+
+    Emails recorded with other detectors, or whose spans no
+    longer match their content, are redacted from scratch.
+    The recorded files and index pages of the rewritten emails
+    are invalidated in the same transaction, so the next
+    transformation writes them again.
+
+    Args:
+        session: the db session to write with
+        batch_size: the number of emails rewritten per commit
+
+    Returns:
+        dict - the number of emails 'checked', 'rewritten' and
+            'rescanned'
+    """
+    if not spans.enabled():
+        raise ValueError('The span index is off.')
+
+    session = session or models.db_session()
+    current = spans.current_policy(session)
+    counts = {'checked': 0, 'rewritten': 0, 'rescanned': 0}
+    table = models.RedactedEmail.__table__
+    update = table.update() \
+                .where(table.c.id == bindparam('_id')) \
+                .values(dict((field, bindparam(field))
+                                for field in detectors.FIELDS))
+    old_policies = session.query(models.RedactionPolicy) \
+                    .filter(models.RedactionPolicy.id != current.id) \
+                    .all()
+
+    for policy in old_policies:
+        rescan = policy.detectors != current.detectors
+
+        if rescan or policy.redaction_string != current.redaction_string:
+            ids = spans.scanned(session, policy)
+        else:
+            changed = set(json.loads(policy.excludes)) \
+                        ^ set(config.excludes)
+            ids = spans.candidates(session, policy, sorted(changed))
+
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            records = [dict(zip(ROW_NAMES, row)) for row in
+                        session.query(*ROW_COLUMNS) \
+                            .filter(models.Email.id.in_(batch)) \
+                            .order_by(models.Email.id) \
+                            .all()]
+            stored = dict((row[0], tuple(row[1:])) for row in
+                            session.query(models.RedactedEmail.id, *[
+                                getattr(models.RedactedEmail, field)
+                                    for field in detectors.FIELDS]) \
+                                .filter(models.RedactedEmail.id.in_(batch)) \
+                                .all())
+            entities = spans.load(session, batch)
+            rewritten = []
+            rescanned = []
+
+            for record in records:
+                if record['id'] not in stored:
+                    continue
+
+                try:
+                    if rescan:
+                        raise spans.StaleSpans('The detectors have changed.')
+
+                    scan_string, found = entities[record['id']]
+                    row = rewrite_record(record, found, scan_string)
+                except spans.StaleSpans:
+                    row = redact_record(record)
+                    rescanned.append(row)
+
+                if tuple(row[field] for field in detectors.FIELDS) \
+                        != stored[record['id']]:
+                    rewritten.append(row)
+
+            if rewritten:
+                session.execute(update, [
+                    dict(_id=row['id'], **dict((field, row[field])
+                            for field in detectors.FIELDS))
+                        for row in rewritten])
+                search.index(session, rewritten)
+                transform.invalidate(
+                    session, models.RedactedEmail.__tablename__,
+                    [row['id'] for row in rewritten])
+
+            spans.index(session, rescanned)
+            spans.move(session, policy, current, batch)
             session.commit()
 
+            counts['checked'] += len(records)
+            counts['rewritten'] += len(rewritten)
+            counts['rescanned'] += len(rescanned)
+
+        # the other emails of the policy aren't changed by the config
+        spans.move(session, policy, current)
+        session.commit()
+
+    return counts
+
+def write_rows(queue, batch_size=100):
+    """
+    Insert redacted rows from a queue into the db, in batches.
+
+    Runs in the writer process until a None is read from
+    the queue.
+
+    Args:
+        queue: the queue of RedactedEmail column values
+        batch_size: the number of rows to insert per commit
+    """
+    # connections must not be shared with the parent process
+    models.db_engine().dispose()
+
+    def rows():
+        while True:
+            row = queue.get()
+
+            if row is None:
+                return
+
+            yield row
+
+    models.bulk_insert(models.RedactedEmail, rows(),
+                        chunk_size=batch_size, session=models.new_session(),
+                        after_chunk=index_rows)
+
+def run_parallel(workers):
+    """
+    Run redaction over a pool of worker processes.
+
+    The main process streams emails out of the db, the workers
+    redact them and a single writer process inserts them, in
+    the same order as the serial run.
+
+    Args:
+        workers: the number of redaction worker processes
+    """
+    # create the cache file's table once, before the workers start
+    redaction_cache()
+
+    queue = multiprocessing.Queue(maxsize=workers * 100)
+    writer = multiprocessing.Process(target=write_rows, args=(queue,))
+    writer.start()
+
+    pool = multiprocessing.Pool(workers)
+
+    try:
+        # the pool reads the rows on a thread of its own
+        for rows in pool.imap(redact_batch, batches(pending_rows())):
+            for row in rows:
+                while True:
+                    try:
+                        queue.put(row, timeout=1)
+                        break
+                    except Full:
+                        if not writer.is_alive():
+                            raise RuntimeError(
+                                'The redaction writer exited.')
+
+        pool.close()
+
+    # stop the workers if any failures
+    except Exception as e:
+        pool.terminate()
+
+        # print the exception
+        ex_type, ex, tb = sys.exc_info()
+        traceback.print_tb(tb)
+        print(e.message)
+
+    finally:
+        pool.join()
+
+        # let the writer flush everything redacted so far
+        if writer.is_alive():
+            queue.put(None)
+
+        writer.join()
+
+def run():
+    """
+    Run redaction.
+    """
+    session = models.new_session()
+
+    try:
+        # go through the emails and redact them in batches
+        models.bulk_insert(
+            models.RedactedEmail,
+            (row for rows in batches(pending_rows())
+                    for row in redact_rows(rows)),
+            chunk_size=100,
+            session=session,
+            after_chunk=index_rows)
+
     # rollback if any failures
     except Exception as e:
         session.rollback()
@@ -313,5 +1602,37 @@ def run():
         traceback.print_tb(tb)
         print(e.message)
 
+    finally:
+        flush_cache()
+        session.close()
+
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description='Run redaction.')
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='the number of redaction worker processes to use')
+    parser.add_argument(
+        '--reapply', action='store_true',
+        help='apply changed excludes and redaction string to the '
+             'redacted emails in the span index')
+    args = parser.parse_args()
+
+    if args.reapply:
+        session = models.new_session()
+
+        try:
+            counts = reapply(session)
+            print('Checked {checked}, rewrote {rewritten} and rescanned '
+                  '{rescanned} redacted emails.'.format(**counts))
+        except ValueError as e:
+            print(e.message)
+        finally:
+            flush_cache()
+            session.close()
+
+        sys.exit()
+
+    if args.workers > 0:
+        run_parallel(args.workers)
+    else:
+        run()
@@ -8,20 +8,332 @@ Author: Anirvan Bhaduri
 Since: 10th Nov 2018
 """
 
+import argparse
+import config
 import extract
+import metrics
+import os
 import redact
+import sys
+import threading
 import transform
+import traceback
 import models
 
+from contextlib import contextmanager
+from Queue import Queue, Empty, Full
+
+# marks the end of a stage's output
+DONE = object()
+
+class PipelineStopped(Exception):
+    """
+    Raised in a pipeline stage when another stage has failed.
+    """
+
+def put(queue, item, failed):
+    """
+    Put an item on a bounded queue, waiting for space unless
+    the pipeline has failed.
+    """
+    while not failed.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return
+        except Full:
+            pass
+
+    raise PipelineStopped()
+
+def items(queue, failed):
+    """
+    Iterate over the items put on a queue until the
+    upstream stage is done.
+    """
+    while True:
+        try:
+            item = queue.get(timeout=1)
+        except Empty:
+            if failed.is_set():
+                raise PipelineStopped()
+
+            continue
+
+        if item is DONE:
+            return
+
+        yield item
+
+def stage(name, work, inbox, outbox, failed):
+    """
+    Run a pipeline stage on a thread.
+
+    Args:
+        name: the name of the stage, for metrics
+        work: callable taking the stage's input items and a
+            function to emit output items with
+        inbox: the queue to read input from, or None
+        outbox: the queue to write output to, or None
+        failed: event set when any stage fails
+
+    Returns:
+        thread: the started stage thread
+    """
+    def emit(item):
+        put(outbox, item, failed)
+
+    def target():
+        try:
+            with metrics.timer('stage_seconds', stage=name):
+                work(items(inbox, failed) if inbox else None, emit)
+
+            if outbox:
+                put(outbox, DONE, failed)
+
+        except PipelineStopped:
+            pass
+
+        except Exception as e:
+            failed.set()
+
+            # print the exception
+            ex_type, ex, tb = sys.exc_info()
+            traceback.print_tb(tb)
+            print(e.message)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread
+
+def extract_stage(persist):
+    """
+    Build the pipeline stage that extracts new emails.
+
+    Args:
+        persist: store the emails and sync checkpoint in the db
+    """
+    def work(inbox, emit):
+        session = models.new_session()
+        query = config.gmail_query
+        extractor = extract.build_extractor()
+        history_id, pages = extract.sync_pages(extractor, session, query)
+
+        try:
+            newest = None
+            next_id = 1
+
+            for number, messages in enumerate(pages, 1):
+                print('Extracting page {}.'.format(number))
+                records = extract.new_records(extractor, messages, session)
+
+                if persist and records:
+                    models.bulk_insert(models.Email, records, session=session)
+
+                    # the db assigns the ids of stored emails
+                    external_ids = [record['external_id']
+                                        for record in records]
+                    ids = dict(session.query(
+                                models.Email.external_id, models.Email.id) \
+                            .filter(models.Email.external_id.in_(
+                                external_ids)) \
+                            .all())
+
+                    for record in records:
+                        record['id'] = ids[record['external_id']]
+                else:
+                    for record in records:
+                        record['id'] = next_id
+                        next_id += 1
+
+                for record in records:
+                    newest = extract.latest(newest, record['time'])
+                    emit(record)
+
+            if persist:
+                extract.finish_sync(
+                    extractor, session, query, history_id, newest)
+
+        finally:
+            session.close()
+
+    return work
+
+def redact_stage(persist):
+    """
+    Build the pipeline stage that redacts emails.
+
+    Emits redacted emails, or the original emails when the
+    configured email type to transform is 'Email'.
+
+    Args:
+        persist: store the redacted emails in the db
+    """
+    def work(inbox, emit):
+        session = models.new_session()
+
+        def redacted():
+            for record in inbox:
+                row = redact.redact_record(record)
+                emit(row if config.email_type == 'RedactedEmail' else record)
+                yield row
+
+        try:
+            if persist:
+                models.bulk_insert(models.RedactedEmail, redacted(),
+                                    chunk_size=100, session=session,
+                                    after_chunk=redact.index_rows)
+            else:
+                for row in redacted():
+                    pass
+
+        finally:
+            redact.flush_cache()
+            session.close()
+
+    return work
+
+def transform_stage(persist):
+    """
+    Build the pipeline stage that writes body files, and the
+    index pages of emails that aren't stored.
+
+    The index pages of stored emails are left to transform's
+    page pass once the pipeline is done, so they are recorded
+    with the same page ranges as a transform run.
+
+    Emails that aren't stored are numbered from 1, so they
+    are written to the configured 'unpersisted_root' instead,
+    and their files aren't recorded, to leave the files of
+    the stored emails alone.
+
+    Args:
+        persist: the emails are stored in the db
+    """
+    def work(inbox, emit):
+        session = models.new_session()
+        email_type = models.__dict__[config.email_type].__tablename__
+        batch_size = getattr(config, 'transform_batch_size', 500)
+        root = config.generation_root
+
+        if not persist:
+            root = getattr(config, 'unpersisted_root', None) or \
+                    os.path.join(config.generation_root, 'unpersisted')
+
+        emitter = transform.FileEmitter(
+                    root,
+                    email_type,
+                    workers=getattr(config, 'files_workers', 4),
+                    shard_size=getattr(config, 'files_shard_size', 0),
+                    record=persist)
+        stream = transform.IndexStream(
+                    root, config.table_columns, emitter, session)
+
+        try:
+            for number, record in enumerate(inbox, 1):
+                if not persist:
+                    stream.write(record)
+                    continue
+
+                emitter.emit(record['id'], record['body'])
+
+                if not number % batch_size:
+                    emitter.flush(session)
+
+            if persist:
+                emitter.flush(session)
+            else:
+                stream.commit()
+
+        finally:
+            emitter.close()
+            session.close()
+
+    return work
+
+@contextmanager
+def instrumented():
+    """
+    Profile the code run in the context if a 'profile_file' is
+    configured, and export the metrics recorded to the
+    configured 'metrics_file' afterwards.
+    """
+    metrics.reset()
+
+    try:
+        with metrics.profiled(getattr(config, 'profile_file', None)):
+            yield
+    finally:
+        metrics_file = getattr(config, 'metrics_file', None)
+
+        if metrics_file:
+            metrics.export(metrics_file)
+
+def run_pipeline(persist=True, queue_size=None):
+    """
+    Run the redactor as a pipeline.
+
+    Each extracted email goes straight to redaction and then
+    to transformation, over bounded queues so a slow stage
+    holds back the ones before it. When the emails are
+    stored, transform's page pass then writes the index pages
+    that changed, otherwise the index pages written cover the
+    emails extracted in this run.
+
+    Args:
+        persist: store the emails and redacted emails in the db,
+            otherwise emails are numbered from 1 in the output
+        queue_size: the maximum number of emails waiting
+            between two stages
+    """
+    queue_size = queue_size or getattr(config, 'pipeline_queue_size', 100)
+    extracted = Queue(queue_size)
+    redacted = Queue(queue_size)
+    failed = threading.Event()
+
+    with instrumented():
+        threads = [
+            stage('extract', extract_stage(persist),
+                    None, extracted, failed),
+            stage('redact', redact_stage(persist),
+                    extracted, redacted, failed),
+            stage('transform', transform_stage(persist),
+                    redacted, None, failed),
+        ]
+
+        for thread in threads:
+            thread.join()
+
+        if persist and not failed.is_set():
+            with metrics.timer('stage_seconds', stage='pages'):
+                transform.run()
+
 def run():
     """
     Run the redactor.
 
     This combines extract, redact and transform.
     """
-    extract.run()
-    redact.run()
-    transform.run()
+    with instrumented():
+        with metrics.timer('stage_seconds', stage='extract'):
+            extract.run()
+
+        with metrics.timer('stage_seconds', stage='redact'):
+            redact.run()
+
+        with metrics.timer('stage_seconds', stage='transform'):
+            transform.run()
 
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description='Run the redactor.')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='stream each email through every stage')
+    parser.add_argument(
+        '--no-persist', dest='persist', action='store_false',
+        help='do not store emails in the db when pipelining')
+    args = parser.parse_args()
+
+    if args.pipeline:
+        run_pipeline(persist=args.persist)
+    else:
+        run()
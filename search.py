@@ -0,0 +1,232 @@
+"""
+The search module.
+
+Keeps a SQLite FTS5 index of the redacted emails, written
+in the same transaction as the redacted emails, and queries
+it for ranked ids and snippets.
+
+Bodies are indexed as text, with html tags stripped, so
+searches don't match markup.
+
+Usage:
+    python search.py "refund invoice" --limit 10
+    python search.py --rebuild
+"""
+
+import argparse
+import config
+import models
+import re
+
+from HTMLParser import HTMLParser
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# the fts5 table of the redacted emails, its rowid is the
+# redacted email id
+TABLE = 'redacted_email_search'
+
+# the redacted email columns that are indexed
+COLUMNS = ('subject', 'email_from', 'email_to', 'body')
+
+# html tags and comments, replaced with spaces when indexing
+TAG = re.compile(r"<!--.*?-->|<[^>]*>", re.S)
+
+# the number of tokens around a match in a snippet
+SNIPPET_TOKENS = 16
+
+_create = text(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, "
+    "tokenize = 'unicode61 remove_diacritics 2')".format(
+        TABLE, ', '.join(COLUMNS)))
+
+_delete = text('DELETE FROM {} WHERE rowid = :id'.format(TABLE))
+
+_insert = text('INSERT INTO {} (rowid, {}) VALUES (:id, {})'.format(
+    TABLE, ', '.join(COLUMNS),
+    ', '.join(':' + column for column in COLUMNS)))
+
+_query = text(
+    'SELECT rowid, bm25({table}), '
+    "snippet({table}, -1, :start, :end, '...', {tokens}) "
+    'FROM {table} WHERE {table} MATCH :query '
+    'ORDER BY bm25({table}) LIMIT :limit'.format(
+        table=TABLE, tokens=SNIPPET_TOKENS))
+
+# whether the index could be created, keyed by engine
+_created = {}
+
+def enabled():
+    """
+    Check whether the search index is kept, with the
+    configured 'search_index'.
+    """
+    return getattr(config, 'search_index', False)
+
+def create(bind):
+    """
+    Create the search index if it doesn't exist.
+
+    Args:
+        bind: the engine, connection or session to create it with
+    """
+    bind.execute(_create)
+
+def prepare(session):
+    """
+    Create the search index the first time a session's engine
+    writes to it.
+
+    Args:
+        session: the db session to create it with
+
+    Returns:
+        bool - whether the index can be written, False when
+            sqlite was built without fts5
+    """
+    engine = session.get_bind()
+
+    if engine not in _created:
+        try:
+            create(session)
+            _created[engine] = True
+
+        except OperationalError as e:
+            print('Not indexing the redacted emails, {}.'.format(e.orig))
+            _created[engine] = False
+
+    return _created[engine]
+
+def plain_text(content):
+    """
+    Get the text of some html content to index.
+    """
+    if not content:
+        return u''
+
+    if '<' not in content:
+        return content
+
+    return HTMLParser().unescape(TAG.sub(u' ', content))
+
+def index(session, records):
+    """
+    Index redacted emails, replacing any earlier entries of
+    the same ids. Does nothing when the search index is off,
+    or sqlite has no fts5.
+
+    Can be given to models.bulk_insert as its after_chunk,
+    so the index is written in the same transaction.
+
+    Args:
+        session: the db session to write with
+        records: list - dicts of the RedactedEmail column values
+    """
+    if not enabled() or not records or not prepare(session):
+        return
+
+    session.execute(_delete, [{'id': record['id']} for record in records])
+    session.execute(_insert, [{
+        'id': record['id'],
+        'subject': record['subject'],
+        'email_from': record['email_from'],
+        'email_to': record['email_to'],
+        'body': plain_text(record['body']),
+    } for record in records])
+
+def rebuild(session=None, batch_size=500):
+    """
+    Index every redacted email again, such as after turning
+    the search index on.
+
+    Args:
+        session: the db session to write with
+        batch_size: the number of emails indexed per commit
+
+    Returns:
+        int - the number of emails indexed
+    """
+    session = session or models.db_session()
+    create(session)
+    session.execute(text('DELETE FROM {}'.format(TABLE)))
+
+    columns = [models.RedactedEmail.id] + \
+                [getattr(models.RedactedEmail, column) for column in COLUMNS]
+    rows = models.stream(
+                lambda reader: reader.query(*columns),
+                models.RedactedEmail.id,
+                batch_size)
+    batch = []
+    count = 0
+
+    for row in rows:
+        batch.append(dict(zip(('id',) + COLUMNS, row)))
+
+        if len(batch) >= batch_size:
+            index(session, batch)
+            session.commit()
+            count += len(batch)
+            batch = []
+
+    index(session, batch)
+    session.commit()
+    return count + len(batch)
+
+def search(query, limit=20, session=None, start='[', end=']'):
+    """
+    Search the redacted emails.
+
+    Args:
+        query: an fts5 query, such as 'refund AND invoice' or
+            'subject: "order shipped"'
+        limit: the maximum number of results
+        session: the db session to query with
+        start: the text put before each match in the snippets
+        end: the text put after each match in the snippets
+
+    Returns:
+        list - a dict of the id, the bm25 rank, lower is better,
+            and a snippet of each matching email, best first
+    """
+    session = session or models.db_session()
+    rows = session.execute(_query, {
+        'query': query,
+        'limit': limit,
+        'start': start,
+        'end': end,
+    }).fetchall()
+
+    return [{'id': row[0], 'rank': row[1], 'snippet': row[2]}
+                for row in rows]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search redacted emails.')
+    parser.add_argument(
+        'query', nargs='?',
+        help='the fts5 query to search for')
+    parser.add_argument(
+        '--limit', type=int, default=20,
+        help='the maximum number of results')
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help='index every redacted email again')
+    args = parser.parse_args()
+
+    session = models.new_session()
+
+    try:
+        if args.rebuild:
+            print('Indexed {} redacted emails.'.format(rebuild(session)))
+
+        if args.query:
+            for result in search(args.query, args.limit, session):
+                print(u'{}\t{}'.format(
+                    result['id'],
+                    u' '.join(result['snippet'].split())).encode('utf8'))
+
+    # fts5 reports bad queries as operational errors
+    except OperationalError as e:
+        print(e.orig)
+
+    finally:
+        session.close()
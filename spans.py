@@ -0,0 +1,264 @@
+"""
+The spans module.
+
+Records where each detector matched in the redacted
+emails, with a hash of the matched value and the domain
+of matched addresses, but never the value itself.
+
+When the 'excludes' or the 'redaction_string' change, the
+redacted emails can be rewritten from their spans without
+running the detectors again, and an exclude only touches
+the emails with a match it could be found in.
+"""
+
+import cache
+import config
+import detectors
+import hashlib
+import json
+import models
+
+from datetime import datetime
+from sqlalchemy import distinct, or_
+
+# the detector name of the redactions made by the html parser
+HTML = 'html'
+
+class StaleSpans(Exception):
+    """
+    Raised when a span no longer holds the value it was
+    recorded with, so the email has to be scanned again.
+    """
+
+def enabled():
+    """
+    Check whether entity spans are recorded, with the
+    configured 'span_index'.
+    """
+    return getattr(config, 'span_index', False)
+
+def value_hash(value):
+    """
+    Hash a matched value.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+
+    return hashlib.sha1(value).hexdigest()
+
+def domain(value):
+    """
+    Get the normalized domain of a matched value, the part
+    after its '@', or None if it has no '@'.
+    """
+    if '@' not in value:
+        return None
+
+    return value.split('@', 1)[1].lower()
+
+def entities(field, content, found):
+    """
+    Describe the matches found in a field.
+
+    Args:
+        field: the name of the email field
+        content: the content the detectors ran over
+        found: list - the (detector name, start, end) of each match
+
+    Returns:
+        list - the [field, detector, start, end, value hash, domain]
+            of each match
+    """
+    return [[field, name, start, end,
+                value_hash(content[start:end]), domain(content[start:end])]
+                    for name, start, end in found]
+
+def detectors_fingerprint():
+    """
+    Fingerprint the registered detectors, spans recorded
+    with other detectors can't be rewritten.
+    """
+    return cache.fingerprint('', [], detectors.registry())
+
+def current_policy(session):
+    """
+    Get the policy of the current config, recording it if
+    it hasn't been seen before.
+
+    Args:
+        session: the db session to query with
+
+    Returns:
+        RedactionPolicy - the policy
+    """
+    values = {
+        'detectors': detectors_fingerprint(),
+        'redaction_string': config.redaction_string,
+        'excludes': json.dumps(sorted(config.excludes)),
+    }
+
+    policy = session.query(models.RedactionPolicy) \
+                .filter_by(**values) \
+                .first()
+
+    if policy is None:
+        policy = models.RedactionPolicy(time=datetime.now(), **values)
+        session.add(policy)
+        session.flush()
+
+    return policy
+
+def index(session, rows):
+    """
+    Record the entity spans of redacted emails, replacing
+    any spans recorded for the same ids before. Does nothing
+    when the span index is off.
+
+    Args:
+        session: the db session to write with
+        rows: list - dicts of the RedactedEmail column values,
+            with their entities under '_spans'
+    """
+    rows = [row for row in rows if '_spans' in row]
+
+    if not enabled() or not rows:
+        return
+
+    policy_id = current_policy(session).id
+    ids = [row['id'] for row in rows]
+    spans = [{
+        'email_id': row['id'],
+        'field': field,
+        'detector': name,
+        'start': start,
+        'end': end,
+        'value_hash': digest,
+        'domain': value_domain,
+    } for row in rows
+        for field, name, start, end, digest, value_domain in row['_spans']]
+
+    session.query(models.EntitySpan) \
+        .filter(models.EntitySpan.email_id.in_(ids)) \
+        .delete(synchronize_session=False)
+
+    if spans:
+        session.execute(models.EntitySpan.__table__.insert(), spans)
+
+    session.execute(models.SpanScan.__table__.insert().prefix_with(
+        'OR REPLACE'), [{
+            'email_id': email_id,
+            'scan_policy_id': policy_id,
+            'policy_id': policy_id,
+        } for email_id in ids])
+
+def candidates(session, policy, excludes):
+    """
+    Get the emails an exclude could be found in a match of.
+
+    Excludes with an '@' are only looked for in matches with
+    a domain starting with the part after the '@', others in
+    every match of an excludable detector.
+
+    Args:
+        session: the db session to query with
+        policy: RedactionPolicy - the policy the emails were
+            last applied with
+        excludes: list - the added or removed excludes
+
+    Returns:
+        list - the ids of the emails, in id order
+    """
+    excludable = [detector.name for detector in detectors.registry()
+                    if detector.excludable]
+
+    if not excludes or not excludable:
+        return []
+
+    conditions = []
+
+    for exclude in excludes:
+        exclude_domain = exclude.split('@', 1)[1] if '@' in exclude else ''
+
+        # the exclude could be found anywhere in a match
+        if not exclude_domain:
+            conditions = None
+            break
+
+        conditions.append(models.EntitySpan.domain.startswith(
+            exclude_domain.lower(), autoescape=True))
+
+    span = models.EntitySpan
+    query = session.query(distinct(span.email_id)) \
+                .join(models.SpanScan,
+                        models.SpanScan.email_id == span.email_id) \
+                .filter(models.SpanScan.policy_id == policy.id,
+                        span.detector.in_(excludable))
+
+    if conditions:
+        query = query.filter(or_(*conditions))
+
+    return sorted(email_id for email_id, in query.all())
+
+def scanned(session, policy):
+    """
+    Get the emails last applied with a policy.
+
+    Returns:
+        list - the ids of the emails, in id order
+    """
+    return [email_id for email_id, in
+                session.query(models.SpanScan.email_id) \
+                    .filter(models.SpanScan.policy_id == policy.id) \
+                    .order_by(models.SpanScan.email_id) \
+                    .all()]
+
+def load(session, ids):
+    """
+    Load the entity spans of some emails.
+
+    Returns:
+        dict - the redaction string the spans were recorded with,
+            and a list of the (field, detector, start, end, value
+            hash) of each span, in field and offset order, keyed
+            by email id
+    """
+    strings = dict(
+        session.query(models.SpanScan.email_id,
+                        models.RedactionPolicy.redaction_string) \
+            .join(models.RedactionPolicy,
+                    models.RedactionPolicy.id == \
+                        models.SpanScan.scan_policy_id) \
+            .filter(models.SpanScan.email_id.in_(ids)) \
+            .all())
+    spans = dict((email_id, []) for email_id in ids)
+    span = models.EntitySpan
+
+    for row in session.query(span.email_id, span.field, span.detector,
+                                span.start, span.end, span.value_hash) \
+                        .filter(span.email_id.in_(ids)) \
+                        .order_by(span.email_id, span.field, span.start) \
+                        .all():
+        spans[row[0]].append(tuple(row[1:]))
+
+    return dict((email_id, (strings.get(email_id), spans[email_id]))
+                    for email_id in ids)
+
+def move(session, old, new, ids=None):
+    """
+    Mark emails applied with one policy as applied with
+    another.
+
+    Args:
+        session: the db session to write with
+        old: RedactionPolicy - the policy they were applied with
+        new: RedactionPolicy - the policy they now reflect
+        ids: list - the ids of the emails, or None for every
+            email recorded with the old policy
+    """
+    query = session.query(models.SpanScan) \
+                .filter(models.SpanScan.policy_id == old.id)
+
+    if ids is not None:
+        query = query.filter(models.SpanScan.email_id.in_(ids))
+
+    query.update({'policy_id': new.id}, synchronize_session=False)
@@ -8,92 +8,289 @@ Author: Anirvan Bhaduri
 Since: 10th Nov 2018
 """
 
-from html import HTML
-
+import cgi
+import hashlib
+import io
+import metrics
 import models
 import config
 import os
+import threading
 
-def create_table(headers, rows):
-    """
-    Create and return an HTML table object given
-    a list of rows.
+from bisect import bisect_left
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import and_, null
 
-    Args:
-        headers: list containing table headers
-        rows: list of lists containing the rows of the table
+def cell_text(item):
+    """
+    Get the text of a table cell, empty for a missing value.
+    """
+    return u'' if item is None else unicode(item)
 
-        headers and rows must be the same length
+class IndexWriter(object):
+    """
+    Writes an html table of emails to an index file, one
+    row at a time, so pages are never held in memory.
 
-    Returns:
-        table: the table containing the input rows
+    The table is written to a temporary file that is moved
+    into place when the page is committed, and its content
+    is hashed as it is written.
     """
-    if not isinstance(headers, TableHeader):
-        raise ValueError('Must provide TableHeader.')
-    
-    if not len(rows) or not isinstance(rows[0], TableRow):
-        raise ValueError('Must provide TableRow.')
 
-    h = HTML()
-    table = h.table(border='1')
-    body = table.tbody
-    body.text(headers.html_element(), escape=False)
+    def __init__(self, root, headers):
+        """
+        IndexWriter constructor.
+
+        Args:
+            root: the root folder to write the index file in
+            headers: list - the table headers
+        """
+        if not os.path.exists(root):
+            os.makedirs(root)
 
-    for row in rows:
-        body.text(row.html_element(), escape=False)
+        self._root = root
+        self._path = os.path.join(root, '.index.html.tmp')
+        self._file = io.open(self._path, 'w', encoding='utf8')
+        self._file.write(u'<table border="1">\n<tbody><tr>')
+        self._digest = hashlib.sha1()
 
-    return table
+        for header in headers:
+            self._file.write(
+                u'<th><b>{}</b></th>'.format(cgi.escape(header)))
+            self._digest.update(header.encode('utf8'))
+            self._digest.update('\0')
 
-class TableRow(object):
-    """
-    Class to capture an html table row.
-    """
+        self._file.write(u'<th><b>Link</b></th></tr>')
 
-    def __init__(self, row, link):
+    def write_row(self, row, link):
         """
-        TableRow constructor.
+        Write a table row.
 
         Args:
             row: A list containing tuples of the form ("header", "value").
             link: The link to the file on the row
         """
-        if not isinstance(row, list):
-            raise ValueError('The row must be a python list.')
+        cells = []
+
+        for header, item in row:
+            text = cell_text(item)
+            cells.append(u'<td>{}</td>'.format(cgi.escape(text)))
+            self._digest.update(text.encode('utf8'))
+            self._digest.update('\0')
 
-        self._row = row
-        self._link = link
-        self._html = HTML()
+        self._digest.update(link.encode('utf8'))
+        self._digest.update('\n')
+        self._file.write(u'<tr>{}<td><a href="{}">{}</a></td></tr>'.format(
+            u''.join(cells), cgi.escape(link, True), cgi.escape(link)))
+
+    def digest(self):
+        """
+        Get the hash of the headers and rows written so far.
+        """
+        return self._digest.hexdigest()
 
-    def html_element(self):
+    def commit(self, name):
         """
-        Return the HTML element representing the 
-        table row.
+        Finish the table and move the index file into place.
+
+        Args:
+            name: the name of the index file
         """
-        row = self._html.tr
-        
-        for header, item in self._row:
-            row.td(item, escape=False)
+        self._file.write(u'</tbody>\n</table>')
+        self._file.close()
+        os.rename(self._path, os.path.join(self._root, name))
 
-        row.td.a(self._link, href=self._link, escape=False)
-        return row
+    def discard(self):
+        """
+        Remove the temporary file, leaving any index file in
+        place as it is.
+        """
+        self._file.close()
+        os.remove(self._path)
 
-class TableHeader(TableRow):
+class PageManifest(object):
     """
-    TableHeader class to capture the table header.
+    Records the id range and content hash of each index
+    page, so pages whose rows haven't changed aren't
+    written again, and pages no longer generated are removed.
+
+    Rows are streamed to a temporary file as they come,
+    which is only moved into place when the page's hash
+    has changed.
     """
 
-    def html_element(self):
+    def __init__(self, root, email_type, headers, session):
+        """
+        PageManifest constructor.
+
+        Args:
+            root: the root folder the index pages are written in
+            email_type: the table name of the emails
+            headers: list - the table headers
+            session: the db session to record the pages with
+        """
+        self._root = root
+        self._email_type = email_type
+        self._headers = headers
+        self._session = session
+        self._digests = dict(
+            session.query(models.GeneratedPage.name,
+                            models.GeneratedPage.digest) \
+                .filter(models.GeneratedPage.email_type == email_type) \
+                .all())
+        self._seen = set()
+        self._writer = None
+
+    def write_row(self, row, link):
+        """
+        Write a table row of the current page, starting the
+        page if needed.
+
+        Args:
+            row: list - the ("header", "value") of each cell
+            link: the link to the email's file
+        """
+        if self._writer is None:
+            self._writer = IndexWriter(self._root, self._headers)
+
+        self._writer.write_row(row, link)
+
+    def commit(self, name, first_id, last_id):
         """
-        Return the HTML element representing the table
-        headers.
+        Finish the current page and move it into place, unless
+        the page already holds the same rows, and record it.
+
+        Args:
+            name: the name of the index file
+            first_id: the first id of the page's range
+            last_id: the last id of the page's range
+
+        Returns:
+            bool - whether the page was written
+        """
+        writer, self._writer = self._writer, None
+        digest = writer.digest()
+        self._seen.add(name)
+
+        if self._digests.get(name) == digest \
+                and os.path.exists(os.path.join(self._root, name)):
+            writer.discard()
+            metrics.incr('transform_pages_skipped_total')
+            return False
+
+        writer.commit(name)
+        metrics.incr('transform_pages_written_total')
+
+        models.bulk_insert(models.GeneratedPage, [{
+            'email_type': self._email_type,
+            'name': name,
+            'first_id': first_id,
+            'last_id': last_id,
+            'digest': digest,
+        }], upsert_on=('email_type', 'name'), session=self._session)
+
+        self._digests[name] = digest
+        return True
+
+    def remove_orphans(self):
+        """
+        Remove the recorded pages that weren't committed in
+        this run, such as a last page that has since grown.
+
+        Returns:
+            int - the number of pages removed
         """
-        row = self._html.tr
+        orphans = sorted(set(self._digests) - self._seen)
+
+        for name in orphans:
+            path = os.path.join(self._root, name)
+
+            if os.path.exists(path):
+                os.remove(path)
+
+            self._session.query(models.GeneratedPage) \
+                .filter(models.GeneratedPage.email_type == self._email_type,
+                        models.GeneratedPage.name == name) \
+                .delete(synchronize_session=False)
+
+            del self._digests[name]
+
+        self._session.commit()
+        metrics.incr('transform_orphans_removed_total', len(orphans),
+                        kind='page')
+        return len(orphans)
+
+def remove_orphaned_files(session, model, root):
+    """
+    Remove the body files of emails that no longer exist.
+
+    Args:
+        session: the db session to query with
+        model: the model of the emails
+        root: the root folder the files are written in
 
-        for header, item in self._row:
-            row.th.b(header)
+    Returns:
+        int - the number of files removed
+    """
+    orphans = session.query(models.GeneratedFile.email_id,
+                            models.GeneratedFile.path) \
+                .outerjoin(model, model.id == models.GeneratedFile.email_id) \
+                .filter(models.GeneratedFile.email_type == model.__tablename__,
+                        model.id == None) \
+                .all()
+
+    for email_id, path in orphans:
+        if os.path.exists(os.path.join(root, path)):
+            os.remove(os.path.join(root, path))
+
+        session.query(models.GeneratedFile) \
+            .filter(models.GeneratedFile.email_type == model.__tablename__,
+                    models.GeneratedFile.email_id == email_id) \
+            .delete(synchronize_session=False)
+
+    session.commit()
+    metrics.incr('transform_orphans_removed_total', len(orphans),
+                    kind='file')
+    return len(orphans)
+
+def invalidate(session, email_type, ids):
+    """
+    Clear the recorded hashes of the body files and index
+    pages of some emails, so the next transformation writes
+    them again. Their paths stay recorded, so they are still
+    removed once no longer generated. Doesn't commit, so it
+    can share the transaction that changed the emails.
 
-        row.th.b('Link')
-        return row
+    Args:
+        session: the db session to write with
+        email_type: the table name of the emails
+        ids: list - the ids of the changed emails
+    """
+    if not ids:
+        return
+
+    ids = sorted(ids)
+    page = models.GeneratedPage
+    pages = [name for name, first_id, last_id in
+                session.query(page.name, page.first_id, page.last_id) \
+                    .filter(page.email_type == email_type,
+                            page.first_id <= ids[-1],
+                            page.last_id >= ids[0]) \
+                    .all()
+                # whether any id falls in the page's range
+                if bisect_left(ids, first_id) < len(ids)
+                    and ids[bisect_left(ids, first_id)] <= last_id]
+
+    session.query(models.GeneratedFile) \
+        .filter(models.GeneratedFile.email_type == email_type,
+                models.GeneratedFile.email_id.in_(ids)) \
+        .update({'digest': None}, synchronize_session=False)
+
+    if pages:
+        session.query(page) \
+            .filter(page.email_type == email_type, page.name.in_(pages)) \
+            .update({'digest': None}, synchronize_session=False)
 
 class Row(object):
     """
@@ -105,12 +302,12 @@ class Row(object):
         Row constructor.
 
         Args:
-            email: an email object
+            email: an email object, or a dict of its column values
             template: list - list of tuples, 
                                 the template to use to convert row
         """
-        self._email = email
-        email_dict = email.__dict__
+        email_dict = email if isinstance(email, dict) else email.__dict__
+        self._email = email_dict
         self._row = []
 
         for key, value in template:
@@ -125,74 +322,360 @@ class Row(object):
         """
         return self._row
 
-    def link_file(self, root):
+    def link_file(self, emitter, stored=None):
         """
-        Generate a file in the given root.
+        Generate a file for the email body using the emitter.
 
         Then update the row to contain a relative link from
-        the root specified.
+        the emitter's root.
+
+        Args:
+            emitter: FileEmitter - the emitter to write the file with
+            stored: tuple - the (path, digest) recorded when the file
+                was last written, if any
+        """
+        return emitter.emit(self._email['id'], self._email['body'], stored)
+
+class FileEmitter(object):
+    """
+    Writes email body files on a bounded pool of threads.
+
+    Files whose recorded content hash still matches are not
+    rewritten, and files can be sharded into subdirectories
+    by id so that no directory holds every file.
+    """
+    directory = 'files'
+
+    def __init__(self, root, email_type, workers=4, shard_size=0,
+                    record=True):
+        """
+        FileEmitter constructor.
+
+        Args:
+            root: the root folder where files will be generated
+            email_type: the table name of the emails
+            workers: the number of writer threads
+            shard_size: the number of ids per subdirectory,
+                0 to write every file to the same directory
+            record: record the hashes of the written files in the db
+        """
+        self._root = root
+        self._email_type = email_type
+        self._shard_size = shard_size
+        self._record = record
+
+        # recorded hashes can't be trusted if the files are gone
+        directory = os.path.join(root, self.directory)
+        self._fresh = not os.path.exists(directory)
+
+        if self._fresh:
+            os.makedirs(directory)
+
+        self._directories = set([self.directory])
+        self._pool = ThreadPool(workers)
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._pending = []
+        self._written = []
+        self._moved = []
+
+    def path(self, email_id):
+        """
+        Get the path of an email's file, relative to the root.
+        """
+        filename = 'file.id.{}.{}'.format(email_id, self._email_type)
+
+        if not self._shard_size:
+            return '{}/{}'.format(self.directory, filename)
+
+        return '{}/{}/{}'.format(
+                    self.directory, email_id // self._shard_size, filename)
+
+    def recorded(self, email_id, stored):
+        """
+        Get the path of an email's file if it was already
+        written, so its body doesn't need loading.
+
+        Redaction clears the recorded hash of an email it
+        writes again, so a file recorded with a hash at the
+        email's path still holds its body, as long as the
+        files directory wasn't removed since.
+
+        Args:
+            email_id: the id of the email
+            stored: tuple - the (path, digest) recorded when the file
+                was last written, if any
+
+        Returns:
+            path: the path of the file relative to the root, or
+                None if the file needs writing
+        """
+        path = self.path(email_id)
+
+        if self._fresh or stored is None or stored[0] != path \
+                or stored[1] is None:
+            return None
+
+        metrics.incr('transform_files_skipped_total')
+        return path
+
+    def emit(self, email_id, body, stored=None):
+        """
+        Write an email's body to its file, unless the file
+        already holds the same content.
+
+        Args:
+            email_id: the id of the email
+            body: the email body
+            stored: tuple - the (path, digest) recorded when the file
+                was last written, if any
+
+        Returns:
+            path: the path of the file, relative to the root
+        """
+        path = self.path(email_id)
+        content = body.encode('utf8')
+        digest = hashlib.sha1(content).hexdigest()
+
+        if not self._fresh and stored == (path, digest):
+            metrics.incr('transform_files_skipped_total')
+            return path
+
+        # the file was recorded under another path, such as
+        # before the shard size changed
+        if stored and stored[0] and stored[0] != path:
+            self._moved.append(stored[0])
+
+        directory = os.path.dirname(path)
+
+        if directory not in self._directories:
+            if not os.path.exists(os.path.join(self._root, directory)):
+                os.makedirs(os.path.join(self._root, directory))
+
+            self._directories.add(directory)
+
+        # bound the number of writes in flight
+        self._slots.acquire()
+        self._pending.append(
+            self._pool.apply_async(self._write, (path, content)))
+        self._written.append({
+            'email_type': self._email_type,
+            'email_id': email_id,
+            'path': path,
+            'digest': digest,
+        })
+
+        return path
+
+    def _write(self, path, content):
+        """
+        Write a file, on a writer thread.
+        """
+        try:
+            with metrics.timer('transform_file_write_seconds'):
+                with open(os.path.join(self._root, path), 'wb') as f:
+                    f.write(content)
+
+            metrics.incr('transform_files_written_total')
+        finally:
+            self._slots.release()
+
+    def flush(self, session):
+        """
+        Wait for the pending writes and record their hashes,
+        if recording, then remove the files they replace at
+        other paths.
+
+        Args:
+            session: the db session to record the hashes with
+        """
+        for result in self._pending:
+            result.get()
+
+        if self._record:
+            models.bulk_insert(models.GeneratedFile, self._written,
+                                upsert_on=('email_type', 'email_id'),
+                                session=session)
+
+        for path in self._moved:
+            if os.path.exists(os.path.join(self._root, path)):
+                os.remove(os.path.join(self._root, path))
+
+        metrics.incr('transform_orphans_removed_total', len(self._moved),
+                        kind='file')
+
+        self._pending = []
+        self._written = []
+        self._moved = []
+
+    def close(self):
+        """
+        Stop the writer threads.
+        """
+        self._pool.close()
+        self._pool.join()
+
+class IndexStream(object):
+    """
+    Writes a stream of emails to index pages of a fixed
+    number of rows, along with their body files.
+    """
+
+    def __init__(self, root, template, emitter, session, page_size=1000):
+        """
+        IndexStream constructor.
+
+        Args:
+            root: the root folder to write the index pages in
+            template: list - the table column definitions
+            emitter: FileEmitter - the emitter to write body files with
+            session: the db session to record body file hashes with
+            page_size: the number of rows per index page
+        """
+        self._root = root
+        self._template = template
+        self._headers = [header for column, header in template]
+        self._emitter = emitter
+        self._session = session
+        self._page_size = page_size
+        self._writer = None
+        self._rows = 0
+        self._first_id = None
+        self._last_id = None
+
+    def write(self, email):
+        """
+        Write an email to the current index page, starting a
+        new page when the current one is full.
 
         Args:
-            root: the root folder where a file will be generated
+            email: dict - the email column values
         """
-        directory = 'files'
+        if self._writer is None:
+            self._writer = IndexWriter(self._root, self._headers)
+            self._first_id = email['id']
 
-        if not os.path.exists('{}/{}'.format(root, directory)):
-            os.makedirs('{}/{}'.format(root, directory))
+        row = Row(email, self._template)
+        self._writer.write_row(row.get(), row.link_file(self._emitter))
+        self._last_id = email['id']
+        self._rows += 1
 
-        email_type = self._email.__tablename__
-        filename = 'file.id.{}.{}'.format(self._email.id, email_type)
-        path_to_file = "{}/{}/{}". \
-                        format(root, directory, filename)
+        if self._rows >= self._page_size:
+            self.commit()
 
-        with open(path_to_file, 'w') as f:
-            f.write(self._email.body.encode('utf8'))
+    def commit(self):
+        """
+        Commit the current index page, if it has any rows.
+        """
+        if self._writer is None:
+            return
 
-        return '{}/{}'.format(directory, filename)
+        self._emitter.flush(self._session)
+        self._writer.commit('{}--{}.index.html'.format(
+                                self._first_id, self._last_id))
+        self._writer = None
+        self._rows = 0
 
-def commit_table(table, name, root):
+def load_bodies(session, model, ids):
     """
-    Create a file with the current table at the root.
+    Load the bodies of some emails.
+
+    Args:
+        session: the db session to query with
+        model: the model of the emails
+        ids: list - the ids of the emails
+
+    Returns:
+        dict - the bodies keyed by email id
     """
-    if not os.path.exists(root):
-        os.makedirs(root)
+    if not ids:
+        return {}
 
-    with open('{}/{}'.format(root, name), 'w') as f:
-        f.write(unicode(table).encode('utf8'))
+    return dict(session.query(model.id, model.body) \
+                    .filter(model.id.in_(ids)) \
+                    .all())
 
 def run():
     """
     Run transformation.
-    """
-    session = models.db_session()
 
+    Only the id and table columns of each email are read, a
+    body is only loaded when its file has to be written, and
+    a page is only written when its rows have changed.
+
+    Table columns the emails don't have are left empty.
+    """
+    session = models.new_session()
+    model = models.__dict__[config.email_type]
+    headers = [header for column, header in config.table_columns]
+    names = ['id'] + [column for column, header in config.table_columns]
+    columns = [getattr(model, name) if name in model.__table__.c
+                    else null().label(name) for name in names] + [
+                models.GeneratedFile.path, models.GeneratedFile.digest]
+    page_size = getattr(config, 'transform_page_size', 1000)
+    batch_size = getattr(config, 'transform_batch_size', 500)
+    emitter = FileEmitter(
+                config.generation_root,
+                model.__tablename__,
+                workers=getattr(config, 'files_workers', 4),
+                shard_size=getattr(config, 'files_shard_size', 0))
+    manifest = PageManifest(
+                config.generation_root, model.__tablename__, headers, session)
+
+    def query(session):
+        return session.query(*columns) \
+                .outerjoin(models.GeneratedFile, and_(
+                    models.GeneratedFile.email_type == model.__tablename__,
+                    models.GeneratedFile.email_id == model.id))
+
+    emails = models.stream(query, model.id, batch_size)
+    page_rows = 0
     base_id = 0
 
-    # use config for query
-    while True:
-        emails = session.query(
-            models.__dict__[config.email_type]) \
-                .filter(models.__dict__[config.email_type].id>base_id) \
-                    .limit(1000).all()
-
-        # discontinue if no more emails to go through
-        if not len(emails):
-            break
-
-        rows = [Row(email, config.table_columns) for email in emails]
-        table_header = TableHeader(rows[0].get(), '')
-
-        table_rows = [
-            TableRow(row.get(), row.link_file(config.generation_root)) 
-                                                        for row in rows
-        ]
-    
-        table = create_table(table_header, table_rows)
-        commit_table(
-                table, '{}--{}.index.html'.format(base_id+1, emails[-1].id), 
-                config.generation_root)
-
-        base_id = emails[-1].id
+    try:
+        while True:
+            batch = list(islice(
+                        emails, min(batch_size, page_size - page_rows)))
+
+            if not batch:
+                break
+
+            links = [emitter.recorded(email[0], tuple(email[-2:]))
+                        for email in batch]
+            bodies = load_bodies(session, model, [
+                        email[0] for email, link in zip(batch, links)
+                            if link is None])
+
+            for email, link in zip(batch, links):
+                values = dict(zip(names, email))
+                row = Row(values, config.table_columns)
+
+                if link is None:
+                    values['body'] = bodies[values['id']]
+                    link = row.link_file(emitter, tuple(email[-2:]))
+
+                manifest.write_row(row.get(), link)
+                page_rows += 1
+                last_id = values['id']
+
+            # commit each full page of the index
+            if page_rows >= page_size:
+                emitter.flush(session)
+                manifest.commit('{}--{}.index.html'.format(base_id+1, last_id),
+                                base_id+1, last_id)
+                base_id = last_id
+                page_rows = 0
+
+        if page_rows:
+            emitter.flush(session)
+            manifest.commit('{}--{}.index.html'.format(base_id+1, last_id),
+                            base_id+1, last_id)
+
+        manifest.remove_orphans()
+        remove_orphaned_files(session, model, config.generation_root)
+
+    finally:
+        emitter.close()
+        session.close()
 
 if __name__ == '__main__':
     run()